@@ -0,0 +1,445 @@
+"""
+Benchmarks for the contacts manager.
+File: bench.py
+
+Usage:
+    python bench.py fix [--size N] [--legacy-size N]
+    python bench.py memory [--size N]
+    python bench.py startup [--size N]
+    python bench.py formats [--size N] [--repeat N]
+    python bench.py scan [--size N] [--repeat N] [--workers N]
+    python bench.py suite [--sizes N,N,...] [--repeat N] [--output results.json]
+    python bench.py compare old.json new.json
+    python bench.py generate [--size N] [--output contacts.json]
+"""
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import final_contacts as fc
+
+FIRST_NAMES = ['John', 'Jane', 'Alex', 'Maria', 'Sam', 'Chris', 'Pat', 'Lee', 'Kim', 'Robin']
+LAST_NAMES = ['Doe', 'Smith', 'Griego', 'Garcia', 'Nguyen', 'Brown', 'Lopez', 'Clark', 'Young', 'King']
+COMPANY_NAMES = ['Doe Inc.', 'Acme', 'Initech', 'Globex', 'Umbrella', '']
+GROUP_NAMES = ['family', 'friends', 'work', 'vip']
+NOTE_WORDS = ['call', 'back', 'about', 'the', 'invoice', 'meeting', 'on', 'friday', 'met', 'at', 'conference',
+              'prefers', 'email', 'birthday', 'in', 'june', 'follow', 'up', 'contract', 'renewal']
+# A few companies and groups hold most of the contacts, the way real address books do
+EXTRA_COMPANIES = 2000
+EXTRA_GROUPS = 200
+LONG_NOTE_RATE = 0.1
+
+def zipf_weights(count, exponent=1.1):
+    """Get weights for count items where the n-th item is picked about 1 / n ** exponent as often as the first.
+    """
+    return [1 / (n + 1) ** exponent for n in range(count)]
+
+def generate_contacts(count, duplicate_rate=0.01, seed=0):
+    """Generate a list of contact dictionaries like the ones stored in contacts.json.
+    Companies and groups follow a skewed distribution, some contacts share an id with an
+    earlier one, and some have notes a few hundred characters long.
+
+    Args:
+        count (int): The number of contacts to generate.
+        duplicate_rate (float): The fraction of contacts that reuse an earlier id.
+        seed (int): The random seed.
+
+    Returns:
+        contacts (list): The contact dictionaries.
+    """
+    rng = random.Random(seed)
+    companies = COMPANY_NAMES + [f"Company {n}" for n in range(EXTRA_COMPANIES)]
+    company_weights = zipf_weights(len(companies))
+    groups = GROUP_NAMES + [f"group{n}" for n in range(EXTRA_GROUPS)]
+    group_weights = zipf_weights(len(groups))
+    contacts = []
+    for i in range(count):
+        if contacts and rng.random() < duplicate_rate:
+            id = rng.choice(contacts)['id']
+        else:
+            id = str(i)
+        first = rng.choice(FIRST_NAMES)
+        last = rng.choice(LAST_NAMES)
+        if rng.random() < LONG_NOTE_RATE:
+            notes = " ".join(rng.choices(NOTE_WORDS, k=rng.randrange(20, 60)))
+        else:
+            notes = ''
+        contacts.append({
+            'id': id,
+            'name': f"{first} {last}",
+            'phone': f"505{rng.randrange(10 ** 7):07d}",
+            'email': f"{first.lower()}.{last.lower()}{i}@example.com",
+            'company': rng.choices(companies, company_weights)[0],
+            'notes': notes,
+            'groups': list(dict.fromkeys(rng.choices(groups, group_weights, k=rng.choice([0, 0, 0, 1, 2]))))
+        })
+    return contacts
+
+def write_dataset(filename, contacts):
+    """Write generated contacts to a contacts file.
+    """
+    with open(filename, 'w') as f:
+        json.dump({'contacts': contacts}, f)
+
+def legacy_fix(contacts, groups, companies):
+    """The fix() implementation before the id index was added, kept for comparison.
+    """
+    for contact in contacts:
+        for c in contacts:
+            if contact != c and contact.id == c.id:
+                contacts.remove(c)
+    for group in groups:
+        for c in groups[group]:
+            if c not in contacts:
+                groups[group].remove(c)
+    for company in companies:
+        for c in companies[company]:
+            if c not in contacts:
+                companies[company].remove(c)
+
+class LegacyContact:
+    """The Contact class before __slots__ were added, kept for comparison.
+    """
+    id = ''
+    name = ''
+    phone = ''
+    email = ''
+    company = ''
+    notes = ''
+    groups = []
+
+    def __init__(self, id, name, phone, email, company, notes, groups):
+        self.id = id
+        self.name = name
+        self.phone = phone
+        self.email = email
+        self.company = company
+        self.notes = notes
+        self.groups = groups
+
+def load(records):
+    """Replace the contacts in final_contacts with the given records.
+    """
+    fc.clear_contacts()
+    fc.contacts_dict_to_list(records)
+
+def bench_fix(size, legacy_size):
+    """Time fix() against the legacy implementation.
+    """
+    records = generate_contacts(size)
+    load(records)
+    start = time.perf_counter()
+    fc.fix()
+    elapsed = time.perf_counter() - start
+    print(f"fix() {size} contacts: {elapsed:.3f}s ({len(fc.CONTACTS)} left)")
+
+    records = generate_contacts(legacy_size)
+    load(records)
+    start = time.perf_counter()
+    legacy_fix(fc.CONTACTS, {g: list(m) for g, m in fc.GROUPS.items()}, {c: list(m) for c, m in fc.COMPANIES.items()})
+    legacy = time.perf_counter() - start
+    print(f"legacy fix() {legacy_size} contacts: {legacy:.3f}s ({len(fc.CONTACTS)} left)")
+    if legacy_size != size:
+        estimate = legacy * (size / legacy_size) ** 2
+        print(f"legacy fix() {size} contacts (quadratic estimate): {estimate:.1f}s")
+
+def measure_contacts(contact_class, lines):
+    """Measure the memory kept by building one contact per JSON line, the way a load does.
+
+    Returns:
+        size (int): The number of bytes allocated for the contacts and their fields.
+    """
+    tracemalloc.start()
+    contacts = [contact_class(**json.loads(line)) for line in lines]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del contacts
+    return size
+
+def bench_memory(size):
+    """Compare the memory used by Contact and LegacyContact objects.
+    """
+    lines = [json.dumps(r) for r in generate_contacts(size)]
+    legacy = measure_contacts(LegacyContact, lines)
+    slotted = measure_contacts(fc.Contact, lines)
+    print(f"LegacyContact {size} contacts: {legacy / 2 ** 20:.1f}MB ({legacy / size:.0f} bytes per contact)")
+    print(f"Contact       {size} contacts: {slotted / 2 ** 20:.1f}MB ({slotted / size:.0f} bytes per contact)")
+    print(f"Saved {(legacy - slotted) / size:.0f} bytes per contact ({100 - slotted * 100 / legacy:.0f}%)")
+
+def time_to_prompt(directory, filename):
+    """Start the program and time how long it takes for the prompt to appear.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'final_contacts.py')
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, script, '-f', filename], cwd=directory, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = b''
+    while not output.endswith(b'> '):
+        output += process.stdout.read(1)
+    elapsed = time.perf_counter() - start
+    process.kill()
+    process.wait()
+    return elapsed
+
+def bench_startup(size):
+    """Time startup with and without the snapshot cache.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'contacts.json')
+        with open(filename, 'w') as f:
+            json.dump({'contacts': generate_contacts(size)}, f)
+        print(f"Time to prompt, {size} contacts: {time_to_prompt(directory, filename):.3f}s")
+
+        fc.clear_contacts()
+        start = time.perf_counter()
+        fc.load_contents(filename)
+        cold = time.perf_counter() - start
+        print(f"Cold load (no cache, writes the cache) {size} contacts: {cold:.3f}s")
+
+        fc.clear_contacts()
+        start = time.perf_counter()
+        fc.load_contents(filename)
+        warm = time.perf_counter() - start
+        print(f"Warm load (from cache) {size} contacts: {warm:.3f}s")
+
+def bench_formats(size, repeat):
+    """Compare the size, save time and load time of the contacts file formats, and check that each
+    one loads back the same contacts. Parsing is also timed on its own, as most of a load is indexing.
+    """
+    formats = [('json', 'contacts.json', False), ('json (compact_json)', 'compact.json', True), ('ndjson', 'contacts.ndjson', False)]
+    compact_json, snapshot_cache = fc.COMPACT_JSON, fc.SNAPSHOT_CACHE
+    fc.SNAPSHOT_CACHE = False
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'source.json')
+        write_dataset(source, generate_contacts(size))
+        fc.clear_contacts()
+        quietly(fc.load_contents, source)
+        expected = [fc.contact_to_dict(c) for c in fc.CONTACTS]
+        print(f"{'Format':<24}{'size MB':>10}{'save ms':>10}{'parse ms':>10}{'load ms':>10}  round trip")
+        for name, basename, compact in formats:
+            filename = os.path.join(directory, basename)
+            fc.COMPACT_JSON = compact
+            save = measure(lambda: fc.save_contents(filename) or len(fc.CONTACTS), repeat)
+
+            def parse():
+                with open(filename) as f:
+                    return sum(1 for _ in fc.iter_contacts_file(f, filename))
+            parsed = measure(parse, repeat)
+
+            def load():
+                fc.clear_contacts()
+                quietly(fc.load_contents, filename)
+                return len(fc.CONTACTS)
+            loaded = measure(load, repeat)
+            same = [fc.contact_to_dict(c) for c in fc.CONTACTS] == expected
+            print(f"{name:<24}{os.path.getsize(filename) / 2 ** 20:>10.1f}{save['p50'] * 1000:>10.0f}{parsed['p50'] * 1000:>10.0f}{loaded['p50'] * 1000:>10.0f}  {'ok' if same else 'DIFFERENT'}")
+    fc.clear_contacts()
+    fc.COMPACT_JSON, fc.SNAPSHOT_CACHE = compact_json, snapshot_cache
+
+def bench_scan(size, repeat, workers):
+    """Time searches that check every contact with parallel_scan off and on, and check that both
+    find the same contacts. Forking the workers costs more than it saves on small stores or one CPU.
+    """
+    parallel_scan, scan_workers = fc.PARALLEL_SCAN, fc.SCAN_WORKERS
+    fc.clear_contacts()
+    load(generate_contacts(size))
+    fc.SCAN_WORKERS = workers
+    print(f"{size} contacts, {os.cpu_count()} CPUs, scan_workers {workers}")
+    print(f"{'Search':<28}{'serial ms':>12}{'parallel ms':>12}  same results")
+    for name, search in (('regex follow.*friday', lambda: fc.regex_search('follow.*friday')),
+                         ('regex notes:^call', lambda: fc.regex_search('^call', 'notes')),
+                         ('substring "jo"', lambda: fc.scan_contacts('substring', 'jo', fc.SEARCH_FIELDS))):
+        timings = []
+        for parallel in (False, True):
+            fc.PARALLEL_SCAN = parallel
+            timings.append(measure(lambda: len(search()), repeat))
+            results = search()
+        fc.PARALLEL_SCAN = False
+        same = results == search()
+        print(f"{name:<28}{timings[0]['p50'] * 1000:>12.0f}{timings[1]['p50'] * 1000:>12.0f}  {'ok' if same else 'DIFFERENT'}")
+    fc.clear_contacts()
+    fc.PARALLEL_SCAN, fc.SCAN_WORKERS = parallel_scan, scan_workers
+
+def percentile(values, p):
+    """Get the p-th percentile of some values, using the nearest rank.
+    """
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def measure(run, repeat, setup=None):
+    """Time an operation.
+    Each run is timed on its own, then it is run once more under tracemalloc to find the
+    most memory it allocated at once, so tracing doesn't slow down the timed runs.
+
+    Args:
+        run (function): The operation. Its return value is reported as the result size.
+        repeat (int): The number of timed runs.
+        setup (function): Called before each run, and not timed.
+
+    Returns:
+        result (dict): The p50, p95, min and max seconds, peak memory in MB and result size.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        size = run()
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        'p50': percentile(times, 50),
+        'p95': percentile(times, 95),
+        'min': min(times),
+        'max': max(times),
+        'runs': repeat,
+        'peak_mb': round(peak / 2 ** 20, 2),
+        'result': size
+    }
+
+def quietly(function, *args, **kwargs):
+    """Call a function with its output thrown away.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+def bench_suite(size, repeat, directory):
+    """Time the main operations on a generated address book.
+
+    Returns:
+        results (dict): The measure() result of each operation.
+    """
+    records = generate_contacts(size)
+    filename = os.path.join(directory, f"contacts-{size}.json")
+    write_dataset(filename, records)
+    snapshot_cache = fc.SNAPSHOT_CACHE
+    results = {}
+
+    def load_file(cache):
+        def run():
+            fc.clear_contacts()
+            fc.SNAPSHOT_CACHE = cache
+            quietly(fc.load_contents, filename)
+            return len(fc.CONTACTS)
+        return run
+
+    results['load_contents'] = measure(load_file(False), repeat)
+    # The first load with the cache on writes it
+    load_file(True)()
+    results['load_contents (cached)'] = measure(load_file(True), repeat)
+    fc.SNAPSHOT_CACHE = snapshot_cache
+
+    for query in ['doe', 'jane smith', records[size // 2]['phone'][3:], 'company:doe', 'groups:vip -company:acme', 'j']:
+        results[f"search {query}"] = measure(lambda: len(fc.search(query.split())), repeat, setup=fc.QUERY_CACHE.clear)
+    results['search doe (cached)'] = measure(lambda: len(fc.search(['doe'])), repeat)
+
+    results['print_contacts (1000 rows)'] = measure(lambda: quietly(fc.print_contacts, fc.CONTACTS[:1000]) or 1000, repeat)
+    results['print_contacts (all)'] = measure(lambda: quietly(fc.print_contacts, fc.CONTACTS) or len(fc.CONTACTS), repeat)
+
+    saved = os.path.join(directory, f"saved-{size}.json")
+    results['save_contents'] = measure(lambda: fc.save_contents(saved) or len(fc.CONTACTS), repeat)
+
+    script = []
+    for i in range(min(size, 10000)):
+        script += ['add', f"name: Bench Person {i}", f"phone: 555{i:07d}", 'company: Acme', 'groups: work']
+    script += [f"remove {555 * 10 ** 7 + i}" for i in range(0, min(size, 10000), 10)]
+    results['execute_commands'] = measure(lambda: quietly(fc.execute_commands, script, quiet=True)[0], repeat, setup=load_file(False))
+
+    results['fix'] = measure(lambda: fc.fix() or len(fc.CONTACTS), repeat, setup=load_file(False))
+    fc.clear_contacts()
+    return results
+
+def print_results(results):
+    """Print the results of bench_suite() as a table.
+    """
+    print(f"{'Operation':<36}{'p50 ms':>10}{'p95 ms':>10}{'peak MB':>10}{'result':>10}")
+    for name, r in results.items():
+        print(f"{name:<36}{r['p50'] * 1000:>10.2f}{r['p95'] * 1000:>10.2f}{r['peak_mb']:>10.2f}{r['result']:>10}")
+
+def run_suite(sizes, repeat, output):
+    """Run bench_suite() for each size, print the results and write them to output as JSON.
+    """
+    report = {
+        'version': fc.VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'sizes': {}
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            print(f"\n{size} contacts")
+            report['sizes'][str(size)] = bench_suite(size, repeat, directory)
+            print_results(report['sizes'][str(size)])
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"\nResults written to '{output}'.")
+
+def compare(old_file, new_file):
+    """Print how the p50 of each operation changed between two results files.
+    """
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    for size, results in new['sizes'].items():
+        print(f"\n{size} contacts")
+        print(f"{'Operation':<36}{'old ms':>10}{'new ms':>10}{'change':>10}")
+        for name, r in results.items():
+            before = old['sizes'].get(size, {}).get(name)
+            if before is None:
+                print(f"{name:<36}{'':>10}{r['p50'] * 1000:>10.2f}")
+                continue
+            change = (r['p50'] - before['p50']) * 100 / before['p50'] if before['p50'] else 0
+            print(f"{name:<36}{before['p50'] * 1000:>10.2f}{r['p50'] * 1000:>10.2f}{change:>+9.0f}%")
+
+def main(args):
+    if not args or args[0] not in ('fix', 'memory', 'startup', 'formats', 'scan', 'suite', 'compare', 'generate'):
+        print(__doc__)
+        return
+    if args[0] == 'compare':
+        compare(args[1], args[2])
+        return
+    size = {'fix': 100000, 'memory': 1000000, 'startup': 100000, 'formats': 100000, 'scan': 200000, 'suite': 10000, 'generate': 100000}[args[0]]
+    legacy_size = 5000
+    if '--size' in args:
+        size = int(args[args.index('--size') + 1])
+    if '--legacy-size' in args:
+        legacy_size = int(args[args.index('--legacy-size') + 1])
+    if args[0] == 'fix':
+        bench_fix(size, legacy_size)
+    elif args[0] == 'memory':
+        bench_memory(size)
+    elif args[0] == 'startup':
+        bench_startup(size)
+    elif args[0] == 'formats':
+        bench_formats(size, int(args[args.index('--repeat') + 1]) if '--repeat' in args else 3)
+    elif args[0] == 'scan':
+        bench_scan(size, int(args[args.index('--repeat') + 1]) if '--repeat' in args else 3,
+                   int(args[args.index('--workers') + 1]) if '--workers' in args else os.cpu_count() or 1)
+    elif args[0] == 'generate':
+        output = args[args.index('--output') + 1] if '--output' in args else f"contacts-{size}.json"
+        write_dataset(output, generate_contacts(size))
+        print(f"Wrote {size} contacts to '{output}'.")
+    else:
+        sizes = [int(n) for n in args[args.index('--sizes') + 1].split(',')] if '--sizes' in args else [10000, 100000]
+        repeat = int(args[args.index('--repeat') + 1]) if '--repeat' in args else 5
+        output = args[args.index('--output') + 1] if '--output' in args else None
+        run_suite(sizes, repeat, output)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
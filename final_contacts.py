@@ -5,12 +5,39 @@ File: final_contacts.py
 Assignment: Final Project
 Date: 11-29-2021
 """
+import array
+import asyncio
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
+import difflib
+import functools
+import heapq
+import http
+import itertools
 import json
+import marshal
+import multiprocessing
 import os
+import pstats
+import re
+import sqlite3
 import sys
+import tempfile
+import threading
 import time
 import shlex
 from json.decoder import JSONDecodeError
+from urllib.parse import parse_qs, unquote, urlsplit
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks on this platform
+    fcntl = None
 
 VERSION = '1.0'
 APPLICATION_NAME = 'Contacts Manager'
@@ -22,6 +49,10 @@ CREDENTIALS_FILE = 'credentials.txt'
 CONFIG_FILE = 'config.txt'
 ALWAYS_SAVE_ON_EXIT = False
 SETTINGS = {}
+TABLE_HEADERS = ("ID", "Name", "Phone", "Email", "Company", "Notes", "Groups")
+MAX_COLUMN_WIDTH = 40
+WRITE_CHUNK_ROWS = 1000
+PAGE_SIZE = 50
 HELP = """
     Commands:
     'exit' to exit the application.
@@ -33,42 +64,167 @@ HELP = """
     'group remove' to remove a contact from a group.
     'group members' to list all contacts in a group.
     'group list' to list all groups.
-    'list contacts' to list all contacts.
+    'list contacts [--page <n>] [--page-size <n>]' to list all contacts, or one page of them.
     'list groups' to list all groups.
-    'search <query>' to search for contacts.
+    'search <query>' to search for contacts. Use 'field:value' to search one field and '-field:value' to exclude matches.
+    'search --regex [field:]<expression>' to search for contacts with a regular expression.
+    'search --top <n> <query>' to show only the n best matches, best first.
+    'lookup <phone|email> <value>' to find the contacts with exactly this phone number or email address, however it is written.
     'group create' to create a group.
     'group delete' to delete a group.
-    'load <filename>' loads contacts from a file.
-    'save' to save the contacts to the default file.
-    'export <filename>' to export the contacts to a file.
-    'commands <filename>' load a set of commands from a file. Should prompt for the file name. Should warn if the file does not exist.
+    'load <filename>' loads contacts from a file. Once contacts are loaded, each file loaded is kept apart and saved back on its own.
+    'unload <filename>' to remove the contacts of a file loaded on top of the contacts file.
+    'save' to save the contacts to the default file, and any changes to other loaded files back to them.
+    'export <filename> [--format csv|vcard|ndjson]' to export the contacts to a file. The format is picked by the extension (.json, .db, .csv, .vcf, .ndjson).
+    'import <filename> [--format csv|vcard|ndjson]' to add the contacts in a CSV, vCard or NDJSON file.
+    'compact' to write all journaled changes into the contacts file.
+    'dedupe [--dry-run]' to find people entered more than once, even with different ids, and merge them.
+    'commands <filename> [--quiet]' load a set of commands from a file. Should prompt for the file name. Should warn if the file does not exist.
+    'stats [on|off|reset|<filename>]' to show the time taken by commands and searches, loads and saves, or write it to a JSON file.
+    'profile <command>' to run a command under the profiler and show where the time went.
     'help' to display a list of commands.
 
     Config:
     'DISABLE_SPLASH_SCREEN' to disable the splash screen.
     'ALWAYS_SAVE_ON_EXIT' to always save the contacts file when exiting.
-    'CONTACTS_FILE' to set the contacts file name.
+    'JOURNAL' to save changes by appending them to a journal next to the contacts file.
+    'PARALLEL_SCAN' to use several processes for searches that have to check every contact.
+    'INSTRUMENTATION' to time commands and the main operations, see 'stats'.
+    'CONTACTS_FILE' to set the contacts file name. Files ending in .db, .sqlite or .sqlite3 are SQLite databases, and .ndjson or .jsonl files have one contact per line.
+    'COMPACT_JSON' to write JSON contacts files with one contact per line instead of indented.
+
+    Run with --serve [--port <n>] to serve the contacts as JSON over HTTP instead.
 """
 DATA = {}
 CONTACTS = []
+# Members of each company and group, as dictionaries used as ordered sets of contacts.
+# Kept in step with each contact's company and groups by every change, and a company or
+# group is removed when its last member leaves.
 COMPANIES = {}
 GROUPS = {}
+# Substring search index: maps every 3 character sequence found in a contact's
+# searchable text to the set of contacts containing it.
+NGRAM_SIZE = 3
+SEARCH_INDEX = {}
+SEARCH_FIELDS = ['id', 'name', 'phone', 'email', 'company', 'notes', 'groups']
+CONTACT_SEQUENCE = itertools.count()
+# Primary key index: maps an id to the first contact with that id. Any later
+# contacts sharing the id are kept in DUPLICATE_IDS until fix() removes them.
+CONTACTS_BY_ID = {}
+DUPLICATE_IDS = {}
+# Exact match indexes: map the digits of a phone number (see phone_key()) and a lowercase email
+# address to the contacts that have it, so they can be looked up however they were typed.
+PHONE_INDEX = {}
+EMAIL_INDEX = {}
+# Name prefix index for ranked searches, built the first time one is run: sorted lists of
+# (key, seq, contact) for each contact's whole lowercase name ('names') and for its name from each
+# later word on ('words'). Contacts indexed since are kept in 'pending' and sorted in once there are
+# PREFIX_PENDING_LIMIT of them. Entries for removed contacts or old names are skipped when found.
+PREFIX_INDEX = {'built': False, 'names': [], 'words': [], 'pending': []}
+PREFIX_PENDING_LIMIT = 1000
+# Ranked searches order results by how well the term matches: an exact id, then an exact match of a
+# field, then a field starting with the term, then the term anywhere. Within each, fields are weighted.
+RANK_WEIGHTS = {'name': 0.9, 'email': 0.8, 'phone': 0.8, 'company': 0.6, 'groups': 0.5, 'notes': 0.3}
+# Contact ids are handed out from a counter that is always above every numeric id in
+# the store, and is saved in the contacts file as 'next_id'.
+NEXT_CONTACT_ID = 1
+CONTACT_ID_WIDTH = 5
+ID_LOCK = threading.Lock()
+# While indexing is deferred, added contacts wait in PENDING_INDEX and are added to the
+# search index, companies and groups together by flush_index().
+INDEXING_DEFERRED = False
+PENDING_INDEX = {}
+# Searches the index can't answer (regular expressions and very short terms) scan every contact.
+# With PARALLEL_SCAN on, stores with at least PARALLEL_SCAN_THRESHOLD contacts are split into
+# shards that are scanned by SCAN_WORKERS processes. The processes are forked, which can deadlock
+# them if other threads are running, so scans run in one process while the contacts file is loading
+# in the background or the API server is handling requests.
+PARALLEL_SCAN = False
+PARALLEL_SCAN_THRESHOLD = 50000
+SCAN_WORKERS = os.cpu_count() or 1
+# Held while the contacts, companies, groups or indexes change so that a background load
+# can run while the main loop answers queries.
+STORE_LOCK = threading.RLock()
+# Counts changes to the contacts. The results of the last QUERY_CACHE_SIZE searches are kept in
+# QUERY_CACHE, most recently used last, with the generation they were found in, and reused while
+# the generation is unchanged.
+STORE_GENERATION = 0
+QUERY_CACHE = collections.OrderedDict()
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_STATS = {'hits': 0, 'misses': 0}
+LOAD_CHUNK_SIZE = 1 << 16
+# Files bigger than this are loaded in the background at startup and show progress when loaded.
+BACKGROUND_LOAD_SIZE = 50 * 1024 * 1024
+LOADER = None
+LOAD_PROGRESS = {'filename': '', 'contacts': 0, 'read': 0, 'size': 0, 'done': True}
+# Absolute paths of contacts files that failed to load. They are never saved over, as that would
+# replace them with the contacts read before the error.
+FAILED_LOADS = set()
+# With LAZY_LOAD the contacts file is loaded in the background at startup and the prompt is shown
+# straight away. Commands that need the contacts wait for files under BACKGROUND_LOAD_SIZE to finish.
+LAZY_LOAD = True
+# A snapshot cache '<contacts file>.cache' holds the contacts and search index of a JSON contacts
+# file in marshal format, and is used instead of parsing the file while the file's modification
+# time and size still match.
+SNAPSHOT_CACHE = True
+CACHE_VERSION = 1
+# Contacts files ending in .ndjson or .jsonl hold a line of metadata and then one contact per line,
+# instead of one JSON document. With COMPACT_JSON, JSON contacts files are written with one contact
+# per line instead of indented, which makes them about half the size and quicker to write.
+COMPACT_JSON = False
+# Journal mode: 'save' appends the changes made since the last save to '<contacts file>.journal'
+# instead of rewriting the contacts file. The journal is folded back into the contacts file
+# once it holds JOURNAL_COMPACT_SIZE changes or when 'compact' is run.
+JOURNAL_MODE = False
+JOURNAL_COMPACT_SIZE = 10000
+PENDING_CHANGES = []
+JOURNAL_SIZE = 0
+# The file the contacts were loaded from, if they have not been mixed with another file since.
+# Only this file can be saved by appending to its journal.
+JOURNAL_BASE = None
+SNAPSHOT_GENERATION = 0
+# The version of JOURNAL_BASE and its journal when they were loaded or last saved, as returned by
+# file_version(). If it has changed by the time of a save, another process saved the file in between
+# and its changes are merged with ours instead of being overwritten.
+FILE_VERSION = None
+# STORAGE keeps the contacts: a MemoryStorage (defined below) holding them in CONTACTS and the indexes, or an
+# SqliteStorage while a contacts file with one of SQLITE_EXTENSIONS is loaded, which reads and writes the
+# database instead. Both have the same methods, which the functions working on the contacts call.
+# Contacts files loaded on top of the contacts file are kept as shards: their contacts are searched with
+# the rest, but each contact's shard is the file it came from and it is only ever saved back there.
+# Maps each shard's filename to its contacts (an ordered set), the changes made to them since it was loaded
+# or saved (recorded the same way as PENDING_CHANGES), the file_version() it was loaded from, and its
+# generation and journal size for journal mode. The contacts file's own contacts have no shard.
+SHARDS = {}
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+# With --serve the contacts are served as JSON over HTTP on SERVER_HOST instead of through the prompt.
+# Changes are saved to the contacts file SAVE_DELAY seconds after the first unsaved change.
+# With INSTRUMENTATION on, the calls to the main operations and the commands typed at the prompt
+# are timed into STATS. Percentiles are taken from the last STATS_SAMPLES calls of each.
+INSTRUMENTATION = False
+STATS = {}
+STATS_SAMPLES = 1000
+STATS_LOCK = threading.Lock()
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8080
+SAVE_DELAY = 2.0
+MAX_REQUEST_SIZE = 1024 * 1024
 
 class Contact:
     """A contact class.
+    Uses __slots__ instead of a per contact __dict__ to keep large address books small.
+    Company and group names are interned so contacts in the same company or group share one string,
+    and groups are stored as a tuple so contacts without groups share the empty tuple.
     """
-    id = ''
-    name = ''
-    phone = ''
-    email = ''
-    company = ''
-    notes = ''
-    groups = []
+    __slots__ = ('id', 'name', 'phone', 'email', '_company', 'notes', '_groups', 'seq', 'shard')
+
     def add_group(self, group):
-        self.groups.append(group)
+        self.groups = self.groups + (group,)
     
     def remove_group(self, group):
-        self.groups.remove(group)
+        groups = list(self.groups)
+        groups.remove(group)
+        self.groups = groups
     
     def __init__(self, id, name, phone, email, company, notes, groups):
         self.id = id
@@ -78,255 +234,2420 @@ class Contact:
         self.company = company
         self.notes = notes
         self.groups = groups
+        self.seq = 0
+        self.shard = None
+
+    @property
+    def company(self):
+        return self._company
+
+    @company.setter
+    def company(self, company):
+        self._company = sys.intern(company)
+
+    @property
+    def groups(self):
+        return self._groups
+
+    @groups.setter
+    def groups(self, groups):
+        self._groups = tuple(sys.intern(g) for g in groups)
+
+    def __str__(self):
+        return f"{self.name} ({self.phone})"
+
+def contact_search_text(contact):
+    """Get the lowercase text that search queries are matched against.
+    Fields are joined with a NUL character so a query can never match across two fields.
+
+    Args:
+        contact (Contact): The contact.
+
+    Returns:
+        text (str): The searchable text of the contact.
+    """
+    fields = [contact.id, contact.name, contact.phone, contact.email, contact.company, contact.notes]
+    fields.extend(contact.groups)
+    return "\0".join(fields).lower()
+
+def ngrams(text):
+    """Get the set of NGRAM_SIZE character sequences in a piece of text.
+    """
+    grams = {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+    return {gram for gram in grams if "\0" not in gram}
+
+def index_contact(contact):
+    """Add a contact to the search index and the phone and email indexes.
+    """
+    for gram in ngrams(contact_search_text(contact)):
+        postings = SEARCH_INDEX.get(gram)
+        if postings is None:
+            SEARCH_INDEX[gram] = {contact}
+        else:
+            postings.add(contact)
+    index_keys(contact)
+    if PREFIX_INDEX['built']:
+        PREFIX_INDEX['pending'].append(contact)
+
+def unindex_contact(contact):
+    """Remove a contact from the search index and the phone and email indexes. Must be called before the contact's fields change.
+    """
+    for gram in ngrams(contact_search_text(contact)):
+        postings = SEARCH_INDEX.get(gram)
+        if postings is not None:
+            postings.discard(contact)
+            if not postings:
+                del SEARCH_INDEX[gram]
+    for index, key in ((PHONE_INDEX, phone_key(contact.phone)), (EMAIL_INDEX, email_key(contact.email))):
+        contacts = index.get(key)
+        if contacts is not None and contact in contacts:
+            contacts.remove(contact)
+            if not contacts:
+                del index[key]
+
+def index_keys(contact):
+    """Add a contact to the phone and email indexes.
+    """
+    for index, key in ((PHONE_INDEX, phone_key(contact.phone)), (EMAIL_INDEX, email_key(contact.email))):
+        if key:
+            contacts = index.get(key)
+            if contacts is None:
+                index[key] = [contact]
+            else:
+                contacts.append(contact)
+
+def phone_key(phone):
+    """Get the digits of a phone number, without a leading 1 country code on 11 digit numbers.
+    """
+    digits = ''.join(c for c in phone if c.isdigit())
+    if len(digits) == 11 and digits[0] == '1':
+        digits = digits[1:]
+    return digits
+
+def email_key(email):
+    """Get an email address in the form used to compare it.
+    """
+    return email.strip().lower()
+
+def register_id(contact):
+    """Add a contact to the id index.
+    """
+    if contact.id.isdigit():
+        reserve_contact_ids(int(contact.id) + 1)
+    if contact.id in CONTACTS_BY_ID:
+        if contact.id not in DUPLICATE_IDS:
+            DUPLICATE_IDS[contact.id] = []
+        DUPLICATE_IDS[contact.id].append(contact)
+    else:
+        CONTACTS_BY_ID[contact.id] = contact
+
+def unregister_id(contact):
+    """Remove a contact from the id index. The next contact with the same id, if any, takes its place.
+    """
+    duplicates = DUPLICATE_IDS.get(contact.id)
+    if CONTACTS_BY_ID.get(contact.id) is contact:
+        if duplicates:
+            CONTACTS_BY_ID[contact.id] = duplicates.pop(0)
+        else:
+            del CONTACTS_BY_ID[contact.id]
+    elif duplicates and contact in duplicates:
+        duplicates.remove(contact)
+    if duplicates is not None and not duplicates:
+        del DUPLICATE_IDS[contact.id]
+
+def store_changed():
+    """Note that the contacts have changed, so that cached search results are no longer used.
+    Called while holding STORE_LOCK, so a search can't cache results from before the change under the new generation.
+    """
+    global STORE_GENERATION
+    STORE_GENERATION += 1
+
+def record_change(change, contact=None):
+    """Remember a change to the contacts so it can be written to the journal on the next save.
+    A change to a contact in a shard is kept with the shard, to be saved to the shard's file.
+    """
+    if contact is not None and contact.shard is not None:
+        SHARDS[contact.shard]['changes'].append(change)
+    else:
+        PENDING_CHANGES.append(change)
+
+def unsaved_changes():
+    """Count the changes made since the contacts were loaded or last saved.
+    """
+    return STORAGE.changes
+
+def is_saved(filename):
+    """Check whether saving to a file would write nothing new, because it is the file the contacts
+    were loaded from (or last saved to) and nothing has changed since.
+    """
+    return STORAGE.is_saved(filename)
+
+def add_contact(contact, record=True):
+    """Add a contact to the contact list, the id index and the search index.
+
+    Args:
+        contact (Contact): The contact to add.
+        record (bool): Record the change for the journal. False when loading contacts from a file.
+    """
+    STORAGE.add(contact, record)
+
+def remove_contact(contact, record=True):
+    """Remove a contact from the contact list, the id index and the search index.
+    """
+    STORAGE.remove(contact, record)
+
+def clear_contacts():
+    """Remove every contact, company and group, and every shard.
+    """
+    with STORE_LOCK:
+        store_changed()
+        CONTACTS.clear()
+        SHARDS.clear()
+        COMPANIES.clear()
+        GROUPS.clear()
+        SEARCH_INDEX.clear()
+        PHONE_INDEX.clear()
+        EMAIL_INDEX.clear()
+        PREFIX_INDEX.update(built=False, names=[], words=[], pending=[])
+        CONTACTS_BY_ID.clear()
+        DUPLICATE_IDS.clear()
+        PENDING_INDEX.clear()
+
+def update_contact(contact, record=True, **fields):
+    """Change fields of a contact and keep the search index in sync.
+
+    Args:
+        contact (Contact): The contact to change.
+        record (bool): Record the change for the journal.
+        **fields: The new field values, eg. name='Jane Doe'.
+    """
+    STORAGE.update(contact, fields, record)
+
+def register_memberships(contact):
+    """Add a contact to the members of its company and groups.
+    """
+    with STORE_LOCK:
+        if contact.company != '':
+            if contact.company not in COMPANIES:
+                COMPANIES[contact.company] = {}
+            COMPANIES[contact.company][contact] = None
+        for g in contact.groups:
+            if g not in GROUPS:
+                GROUPS[g] = {}
+            GROUPS[g][contact] = None
+
+def unregister_memberships(contact):
+    """Remove a contact from the members of its company and groups, dropping any that are left empty.
+    """
+    with STORE_LOCK:
+        for members, name in [(COMPANIES, contact.company)] + [(GROUPS, g) for g in contact.groups]:
+            if contact in members.get(name, ()):
+                del members[name][contact]
+                if not members[name]:
+                    del members[name]
+
+def defer_indexing(deferred):
+    """Turn deferred indexing on or off. Turning it off indexes every contact added in the meantime.
+    Used to add many contacts at once without indexing each one as it is added.
+    """
+    global INDEXING_DEFERRED
+    with STORE_LOCK:
+        INDEXING_DEFERRED = deferred
+        if not deferred:
+            flush_index()
+
+def flush_index():
+    """Add the contacts waiting in PENDING_INDEX to the search index, companies and groups.
+    """
+    with STORE_LOCK:
+        for contact in PENDING_INDEX:
+            index_contact(contact)
+            register_memberships(contact)
+        PENDING_INDEX.clear()
+
+def add_to_group(group_name, contact, record=True):
+    """Add a contact to a group.
+
+    Returns:
+        added (bool): False if the contact was already in the group.
+    """
+    return STORAGE.add_to_group(group_name, contact, record)
+
+def remove_from_group(group_name, contact, record=True):
+    """Remove a contact from a group.
+
+    Returns:
+        removed (bool): False if the contact was not in the group.
+    """
+    return STORAGE.remove_from_group(group_name, contact, record)
+
+def contact_row(ct):
+    """Get the values shown in each column of the contacts table for a contact.
+    """
+    return (ct.id, ct.name, ct.phone, ct.email, ct.company, ct.notes, ", ".join(ct.groups))
+
+def print_contacts(cts, offset=0, limit=None):
+    """Print the contacts in a list. With column headers and spaces in between.
+    Each column is as wide as the longest value shown in it, up to MAX_COLUMN_WIDTH,
+    and rows are written WRITE_CHUNK_ROWS at a time instead of one print per contact.
+
+    Args:
+        cts (list): The contacts.
+        offset (int): The number of contacts to skip.
+        limit (int): The most contacts to show, or None for all of them.
+    """
+    if offset or limit is not None:
+        cts = cts[offset:None if limit is None else offset + limit]
+    widths = [len(h) for h in TABLE_HEADERS]
+    for ct in cts:
+        widths = [max(w, len(v)) for w, v in zip(widths, contact_row(ct))]
+    widths = [min(w, MAX_COLUMN_WIDTH) + 2 for w in widths]
+
+    def format_row(row):
+        values = [v if len(v) <= w - 2 else v[:w - 5] + '...' for v, w in zip(row, widths)]
+        return "".join(v.ljust(w) for v, w in zip(values, widths)).rstrip() + "\n"
+
+    lines = ["\n", format_row(TABLE_HEADERS)]
+    for ct in cts:
+        lines.append(format_row(contact_row(ct)))
+        if len(lines) >= WRITE_CHUNK_ROWS:
+            sys.stdout.write("".join(lines))
+            lines = []
+    lines.append("\n\n")
+    sys.stdout.write("".join(lines))
+
+def print_companies():
+    """Print the companies in a list and the number of contacts per company.
+    """
+    print("\n{:<20}{:<20}".format("Company", "# of Contacts"))
+    for company, count in company_counts().items():
+        print("{:<20}{:<20}".format(company, count))
+
+def print_groups():
+    """Print the groups in a list and the number of contacts per group.
+    """
+    print("\n{:<20}{:<20}".format("Group", "# of Contacts"))
+    for group, count in group_counts().items():
+        print("{:<20}{:<20}".format(group, count))
+
+def count_contacts():
+    """Get the number of contacts.
+    """
+    return STORAGE.count()
+
+def list_contacts(offset=0, limit=None):
+    """Get the contacts in the order they were added.
+
+    Args:
+        offset (int): The number of contacts to skip.
+        limit (int): The most contacts to return, or None for all of them.
+    """
+    return list(STORAGE.contacts(offset, limit))
+
+def company_counts():
+    """Get the number of contacts in each company.
+    """
+    return STORAGE.company_counts()
+
+def group_counts():
+    """Get the number of contacts in each group.
+    """
+    return STORAGE.group_counts()
+
+def get_contact_by_id(id):
+    """Get a contact by id.
+
+    Args:
+        id (str): The identifier of the contact.
+
+    Returns:
+        contact (Contact): The contact object.
+    """
+    if type(id) == list:
+        return [STORAGE.get(ct) for ct in id]
+    return STORAGE.get(id)
+
+def yorn_prompt(prompt, default="y", show_proceed=True):
+    print(prompt)
+    default = {"y": True, "n": False}[default.lower()]
+    while True:
+        print("{}({}/{})? ".format("Proceed " if show_proceed else "", "[y]" if default else "y", "[n]" if not default else "n"), end="")
+        response = input().lower()
+        if response == "":
+            return default
+        elif response[0] == "y":
+            return True
+        elif response[0] == "n":
+            return False
+        else:
+            print("Invalid choice: {}".format(response))
+
+def record_timing(name, seconds, size=None):
+    """Add a call to the statistics kept in STATS.
+
+    Args:
+        name (str): What was called, eg. 'search'.
+        seconds (float): How long it took.
+        size (int): The number of results it returned, or None.
+    """
+    with STATS_LOCK:
+        stat = STATS.get(name)
+        if stat is None:
+            stat = STATS[name] = {'calls': 0, 'total': 0.0, 'max': 0.0, 'results': None, 'samples': collections.deque(maxlen=STATS_SAMPLES)}
+        stat['calls'] += 1
+        stat['total'] += seconds
+        stat['max'] = max(stat['max'], seconds)
+        stat['samples'].append(seconds)
+        if size is not None:
+            stat['results'] = (stat['results'] or 0) + size
+
+def instrumented(name):
+    """Decorate a function so that its calls are recorded with record_timing() while INSTRUMENTATION is on.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            record_timing(name, time.perf_counter() - start, len(result) if type(result) in (list, dict) else None)
+            return result
+        return wrapper
+    return decorate
+
+def stats_report():
+    """Summarize STATS.
+
+    Returns:
+        report (dict): For each name, the number of calls, the total, mean, p50, p95 and maximum seconds,
+            and the mean number of results, or None if it doesn't return a list.
+    """
+    report = {}
+    with STATS_LOCK:
+        for name, stat in sorted(STATS.items()):
+            samples = sorted(stat['samples'])
+            report[name] = {
+                'calls': stat['calls'],
+                'total': stat['total'],
+                'mean': stat['total'] / stat['calls'],
+                'p50': samples[(len(samples) - 1) // 2],
+                'p95': samples[max(0, -(-len(samples) * 95 // 100) - 1)],
+                'max': stat['max'],
+                'mean_results': None if stat['results'] is None else stat['results'] / stat['calls']
+            }
+    return report
+
+def query_cache_stats():
+    """Get the number of searches answered from QUERY_CACHE and the number that had to be run.
+    """
+    with STORE_LOCK:
+        hits = QUERY_CACHE_STATS['hits']
+        misses = QUERY_CACHE_STATS['misses']
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0, 'entries': len(QUERY_CACHE)}
+
+def print_stats():
+    """Print the statistics recorded while INSTRUMENTATION is on, and the query cache statistics.
+    """
+    cache = query_cache_stats()
+    print(f"Query cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%} hit rate), {cache['entries']} cached searches")
+    report = stats_report()
+    if not report:
+        print("No statistics recorded." if INSTRUMENTATION else "Instrumentation is off. Use 'stats on' to turn it on.")
+        return
+    print(f"{'Name':<24}{'Calls':>8}{'Total s':>10}{'Mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'Max ms':>10}{'Results':>10}")
+    for name, r in report.items():
+        print(f"{name:<24}{r['calls']:>8}{r['total']:>10.3f}{r['mean'] * 1000:>10.2f}{r['p50'] * 1000:>10.2f}"
+              f"{r['p95'] * 1000:>10.2f}{r['max'] * 1000:>10.2f}{'-' if r['mean_results'] is None else round(r['mean_results'], 1):>10}")
+
+def write_stats(filename):
+    """Write the statistics to a JSON file.
+    """
+    with open(filename, 'w') as f:
+        json.dump({'timings': stats_report(), 'query_cache': query_cache_stats()}, f, indent=4)
+
+@instrumented('search')
+def search(search_terms, fields = 'all', advanced=False):
+    """Search for a contact.
+    A term written as 'field:value' only matches that field, eg. 'company:doe', and a '-' in front
+    of it excludes the contacts it matches, eg. '-groups:vip'. The other terms are joined together
+    and matched against every field.
+
+    Args:
+        search_terms (list): The search terms.
+        fields (list): With advanced, the field to search for each term, or 'all' for every field.
+        advanced (bool): Match each term only against its field in fields.
+    
+    Returns:
+        results (list): A list of contacts that match the search terms.
+    """
+    if advanced:
+        predicates = [(field, term, False) for field, term in zip(fields, search_terms)]
+    else:
+        predicates = parse_query(search_terms)
+    key = tuple((field, value if field == 'id' else value.lower(), excluded) for field, value, excluded in predicates)
+    with STORE_LOCK:
+        cached = QUERY_CACHE.get(key)
+        if cached is not None and cached[0] == STORE_GENERATION:
+            QUERY_CACHE.move_to_end(key)
+            QUERY_CACHE_STATS['hits'] += 1
+            return list(cached[1])
+        QUERY_CACHE_STATS['misses'] += 1
+        results = STORAGE.search(predicates)
+        QUERY_CACHE[key] = (STORE_GENERATION, results)
+        QUERY_CACHE.move_to_end(key)
+        if len(QUERY_CACHE) > QUERY_CACHE_SIZE:
+            QUERY_CACHE.popitem(last=False)
+        return list(results)
+
+def parse_query(search_terms):
+    """Split search terms into (field, value, excluded) predicates.
+
+    Args:
+        search_terms (list): The search terms.
+
+    Returns:
+        predicates (list): The predicates. Terms without a field are joined into one 'all' predicate.
+    """
+    predicates = []
+    plain = []
+    for term in search_terms:
+        excluded = term.startswith('-')
+        field, sep, value = term[1 if excluded else 0:].partition(':')
+        if sep and field in SEARCH_FIELDS:
+            predicates.append((field, value, excluded))
+        else:
+            plain.append(term)
+    if plain or not [p for p in predicates if not p[2]]:
+        predicates.insert(0, ('all', " ".join(plain), False))
+    return predicates
+
+def plan_search(predicates):
+    """Find the contacts matching every predicate.
+    Candidates are taken from whichever index gives the fewest for a single predicate
+    (the id index, the company and group lists or the search index), and only those
+    candidates are checked against the rest of the predicates.
+
+    Args:
+        predicates (list): (field, value, excluded) predicates from parse_query().
+
+    Returns:
+        results (list): The matching contacts in the order they were added.
+    """
+    predicates = [(field, value if field == 'id' else value.lower(), excluded) for field, value, excluded in predicates]
+    best = None
+    for field, value, excluded in predicates:
+        if excluded:
+            continue
+        source = candidate_source(field, value)
+        if best is None or source[0] < best[0]:
+            best = source
+    results = []
+    for c in best[1]():
+        if not is_stored(c):
+            continue
+        for field, value, excluded in predicates:
+            if field_matches(c, field, value) == excluded:
+                break
+        else:
+            results.append(c)
+    results.sort(key=lambda c: c.seq)
+    return results
+
+def candidate_source(field, value):
+    """Estimate how many candidates an index gives for one predicate.
+
+    Returns:
+        estimate (int): The most candidates the index can give.
+        candidates (function): Returns the candidates.
+    """
+    if field == 'id':
+        found = [CONTACTS_BY_ID[value]] + DUPLICATE_IDS.get(value, []) if value in CONTACTS_BY_ID else []
+        return len(found), lambda: found
+    if field == 'company' and not value:
+        # Every contact matches, including those without a company, which aren't in COMPANIES
+        return len(CONTACTS), lambda: CONTACTS
+    if field == 'company' or field == 'groups':
+        members = COMPANIES if field == 'company' else GROUPS
+        keys = [k for k in members if value in k.lower()]
+        return sum(len(members[k]) for k in keys), lambda: dict.fromkeys(c for k in keys for c in members[k])
+    if len(value) < NGRAM_SIZE:
+        return len(CONTACTS), lambda: CONTACTS
+    postings = sorted((SEARCH_INDEX.get(gram, ()) for gram in ngrams(value)), key=len)
+
+    def intersect():
+        candidates = set(postings[0])
+        for p in postings[1:]:
+            if not candidates:
+                break
+            candidates &= p
+        return candidates
+    return len(postings[0]), intersect
+
+def field_matches(contact, field, value):
+    """Check whether a field of a contact matches a lowercase search value. Ids must match exactly.
+    """
+    if field == 'id':
+        return contact.id == value
+    if field == 'all':
+        return value in contact_search_text(contact)
+    if field == 'groups':
+        return any(value in g.lower() for g in contact.groups)
+    return value in getattr(contact, field).lower()
+
+def is_stored(contact):
+    """Check whether a contact is still in CONTACTS.
+    """
+    return CONTACTS_BY_ID.get(contact.id) is contact or contact in DUPLICATE_IDS.get(contact.id, [])
+
+def search_index(search_term):
+    """Find the contacts whose searchable text contains a lowercase search term.
+    Candidates are found by intersecting the search index sets of every sequence in the
+    term, smallest first, and then checked against the contact's text.
+
+    Args:
+        search_term (str): The lowercase search term.
+
+    Returns:
+        results (list): The matching contacts in the order they were added.
+    """
+    if len(search_term) < NGRAM_SIZE:
+        # Too short to use the index
+        return scan_contacts('substring', search_term, SEARCH_FIELDS)
+    postings = sorted((SEARCH_INDEX.get(gram, ()) for gram in ngrams(search_term)), key=len)
+    candidates = set(postings[0])
+    for p in postings[1:]:
+        if not candidates:
+            break
+        candidates &= p
+    results = [c for c in candidates if search_term in contact_search_text(c)]
+    results.sort(key=lambda c: c.seq)
+    return results
+
+def scan_contacts(kind, pattern, fields):
+    """Find contacts by checking every contact.
+
+    Args:
+        kind (str): 'regex' for a case insensitive regular expression, 'substring' for a lowercase substring.
+        pattern (str): The pattern to look for.
+        fields (list): The fields to look in.
+
+    Returns:
+        results (list): The matching contacts in the order they were added.
+
+    Raises:
+        re.error: If the regular expression is invalid, before any work is started.
+    """
+    return STORAGE.scan(kind, pattern, fields)
+
+def scan_shard(start, stop, kind, pattern, fields):
+    """Check the contacts from CONTACTS[start] up to CONTACTS[stop].
+    Regular expressions are passed in compiled.
+
+    Returns:
+        matches (list): The positions of the matching contacts.
+    """
+    if kind == 'regex':
+        match = pattern.search
+    else:
+        def match(text):
+            return pattern in text.lower()
+    matches = []
+    if kind == 'substring' and fields == SEARCH_FIELDS:
+        for i in range(start, stop):
+            if pattern in contact_search_text(CONTACTS[i]):
+                matches.append(i)
+        return matches
+    for i in range(start, stop):
+        c = CONTACTS[i]
+        for field in fields:
+            values = c.groups if field == 'groups' else (getattr(c, field),)
+            if any(match(v) for v in values):
+                matches.append(i)
+                break
+    return matches
+
+def regex_search(pattern, field='all'):
+    """Search for contacts with a field matching a regular expression. Case is ignored.
+
+    Args:
+        pattern (str): The regular expression.
+        field (str): The field to search, or 'all' for every field.
+
+    Returns:
+        results (list): A list of contacts that match the expression.
+    """
+    return scan_contacts('regex', pattern, SEARCH_FIELDS if field == 'all' else [field])
+
+@instrumented('lookup')
+def lookup(field, value):
+    """Find the contacts with exactly this phone number or email address, however it is formatted,
+    eg. '505-932-4523' finds '(505) 932 4523'.
+
+    Args:
+        field (str): 'phone' or 'email'.
+        value (str): The phone number or email address.
+
+    Returns:
+        results (list): The contacts in the order they were added.
+    """
+    key = phone_key(value) if field == 'phone' else email_key(value)
+    if not key:
+        return []
+    return STORAGE.lookup(field, key)
+
+def name_keys(contact):
+    """Get a contact's keys in the name prefix index.
+
+    Returns:
+        name (str): The lowercase name.
+        words (list): The lowercase name from each word after the first on, eg. 'doe-smith' and 'smith' for 'Jane Doe-Smith'.
+    """
+    name = contact.name.lower()
+    return name, [name[m.start():] for m in re.finditer(r"(?<=\W)\w", name)]
+
+def update_prefix_index():
+    """Build the name prefix index, or sort the contacts indexed since it was built into it.
+    """
+    if not PREFIX_INDEX['built']:
+        contacts = CONTACTS
+    elif len(PREFIX_INDEX['pending']) >= PREFIX_PENDING_LIMIT:
+        contacts = PREFIX_INDEX['pending']
+    else:
+        return
+    names = PREFIX_INDEX['names'] if PREFIX_INDEX['built'] else []
+    words = PREFIX_INDEX['words'] if PREFIX_INDEX['built'] else []
+    for c in contacts:
+        name, later = name_keys(c)
+        names.append((name, c.seq, c))
+        words.extend((key, c.seq, c) for key in later)
+    # Drop the entries of removed contacts and old names while sorting
+    PREFIX_INDEX['names'] = sorted({e for e in names if is_stored(e[2]) and e[2].name.lower() == e[0]})
+    PREFIX_INDEX['words'] = sorted({e for e in words if is_stored(e[2]) and e[2].name.lower().endswith(e[0])})
+    PREFIX_INDEX.update(built=True, pending=[])
+
+def prefix_matches(which, prefix):
+    """Find the contacts with a name key starting with a prefix, in alphabetical order of the keys.
+
+    Args:
+        which (str): 'names' to match the start of the name, 'words' to match the start of any later word.
+        prefix (str): The lowercase prefix.
+
+    Yields:
+        entry (tuple): (key, seq, contact) of each match that is still current.
+    """
+    entries = PREFIX_INDEX[which]
+
+    def indexed():
+        for i in range(bisect.bisect_left(entries, (prefix,)), len(entries)):
+            if not entries[i][0].startswith(prefix):
+                break
+            yield entries[i]
+
+    pending = []
+    for c in PREFIX_INDEX['pending']:
+        name, later = name_keys(c)
+        pending.extend((key, c.seq, c) for key in ([name] if which == 'names' else later) if key.startswith(prefix))
+    for entry in heapq.merge(indexed(), sorted(pending)):
+        c = entry[2]
+        if is_stored(c) and (c.name.lower() == entry[0] if which == 'names' else c.name.lower().endswith(entry[0])):
+            yield entry
+
+def rank_score(contact, term):
+    """Score how well a contact matches a lowercase search term, see RANK_WEIGHTS.
+    An exact id scores 5, an exact field 4, a field starting with the term 3 and the term anywhere 2,
+    plus the weight of the field. Notes only count as containing the term.
+    """
+    if contact.id.lower() == term:
+        return 5.0
+    best = 0.0
+    for field, weight in RANK_WEIGHTS.items():
+        for value in (contact.groups if field == 'groups' else (getattr(contact, field),)):
+            value = value.lower()
+            if field == 'notes':
+                tier = 2 if term in value else 0
+            elif value == term or (field == 'phone' and phone_key(term) and phone_key(value) == phone_key(term)):
+                tier = 4
+            elif value.startswith(term):
+                tier = 3
+            elif field == 'name' and any(key.startswith(term) for key in name_keys(contact)[1]):
+                tier, weight = 3, 0.85
+            elif term in value:
+                tier = 2
+            else:
+                continue
+            best = max(best, tier + weight)
+    return best
+
+@instrumented('ranked_search')
+def ranked_search(search_terms, k):
+    """Search for contacts and return only the k best matches, best first.
+    For a plain search term, the exact matches are found from the id, phone, email, company, group and name
+    indexes, then names starting with the term from the name prefix index, and the search stops there
+    once it has k contacts. Only if it doesn't are the rest of the matches scored, keeping the best
+    k in a heap. Ties are broken by name, except among names starting with the term, which are taken
+    in order of the part of the name matched.
+
+    Args:
+        search_terms (list): The search terms, as for search().
+        k (int): The most contacts to return.
+
+    Returns:
+        results (list): The best matching contacts.
+    """
+    predicates = parse_query(search_terms)
+    term = predicates[0][1].lower().strip() if predicates[0][0] == 'all' else ''
+    if len(predicates) > 1 or not term:
+        return best_matches(search(search_terms), term, k)
+    return STORAGE.ranked_search(search_terms, predicates[0][1], k)
+
+def best_matches(candidates, term, k):
+    """Get the k best of some contacts for a search term, best first, breaking ties by name.
+    """
+    return heapq.nsmallest(k, candidates, key=lambda c: (-rank_score(c, term), c.name.lower(), c.seq))
+
+def generate_contact_id():
+    """Generate a unique identifier for a contact.
+
+    Returns:
+        identifier (str): A unique identifier.
+    """
+    return allocate_contact_ids(1)[0]
+
+def allocate_contact_ids(count):
+    """Reserve a block of unique contact identifiers.
+    Safe to call from several threads at once.
+
+    Args:
+        count (int): The number of identifiers to reserve.
+
+    Returns:
+        identifiers (list): The identifiers, in increasing order.
+    """
+    global NEXT_CONTACT_ID
+    with ID_LOCK:
+        start = NEXT_CONTACT_ID
+        NEXT_CONTACT_ID += count
+    return [str(i).zfill(CONTACT_ID_WIDTH) for i in range(start, start + count)]
+
+def reserve_contact_ids(next_id):
+    """Make sure ids below next_id are never handed out.
+    """
+    global NEXT_CONTACT_ID
+    with ID_LOCK:
+        if next_id > NEXT_CONTACT_ID:
+            NEXT_CONTACT_ID = next_id
+
+def contacts_dict_to_list(contact_dict, shard=None):
+    """Convert the contacts dictionary to a list of contact objects.
+    """
+    for contact in contact_dict:
+        c = Contact(contact['id'], contact['name'], contact['phone'], contact['email'], contact['company'], contact['notes'], contact['groups'])
+        c.shard = shard
+        add_contact(c, record=False)
+
+def contacts_list_to_dict(contact_list):
+    """Convert the contacts list to a dictionary of contact objects.
+    """
+    converted_contacts = []
+    for contact in contact_list:
+        converted_contacts.append(contact_to_dict(contact))
+    return converted_contacts
+
+def contact_to_dict(contact):
+    """Convert a contact object to a dictionary.
+    """
+    return {
+        'id': contact.id,
+        'name': contact.name,
+        'phone': contact.phone,
+        'email': contact.email,
+        'company': contact.company,
+        'notes': contact.notes,
+        'groups': list(contact.groups)
+    }
+
+def iter_json_contacts(f, metadata=None, chunk_size=LOAD_CHUNK_SIZE):
+    """Parse the "contacts" array of a contacts file one record at a time.
+    Only the record being parsed is held in memory, so contacts can be used as soon as they are read.
+
+    Args:
+        f (file): The open contacts file.
+        metadata (dict): If given, any other top-level values in the file are stored in it.
+        chunk_size (int): The number of characters to read at a time.
+
+    Yields:
+        contact (dict): The next contact dictionary.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def read_more():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        LOAD_PROGRESS['read'] += len(chunk)
+        buf = buf[pos:] + chunk
+        pos = 0
+        return True
+
+    def peek():
+        # Skip whitespace and return the next character
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not read_more():
+                raise JSONDecodeError("Unexpected end of file", buf, pos)
+
+    def expect(char):
+        nonlocal pos
+        if peek() != char:
+            raise JSONDecodeError(f"Expecting '{char}'", buf, pos)
+        pos += 1
+
+    def read_value():
+        nonlocal pos
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except JSONDecodeError:
+                # The value may continue in the next chunk
+                if read_more():
+                    continue
+                raise
+            if end == len(buf) and not eof and read_more():
+                # A number could be cut off at the end of the chunk
+                continue
+            pos = end
+            return value
+
+    def next_item(end):
+        # Skip the comma between items and check whether the object or array ends
+        nonlocal pos
+        if peek() == end:
+            pos += 1
+            return False
+        if not first:
+            expect(',')
+        return True
+
+    expect('{')
+    first = True
+    while next_item('}'):
+        first = False
+        key = read_value()
+        expect(':')
+        if key != 'contacts':
+            value = read_value()
+            if metadata is not None:
+                metadata[key] = value
+            continue
+        expect('[')
+        first = True
+        while next_item(']'):
+            first = False
+            yield read_value()
+        first = False
+
+def is_ndjson_file(filename):
+    """Check whether a contacts file is an NDJSON file, by its extension.
+    """
+    return FORMAT_EXTENSIONS.get(os.path.splitext(filename)[1].lower()) == 'ndjson'
+
+def iter_contacts_file(f, filename, metadata=None):
+    """Parse the contacts in a JSON or NDJSON contacts file one record at a time, see iter_json_contacts().
+    """
+    if is_ndjson_file(filename):
+        return read_ndjson_contacts(f, metadata)
+    return iter_json_contacts(f, metadata)
+
+def load_contents(filename, background=False):
+    """Load the contacts file from CONTACTS_FILE.
+    Contacts are added as they are parsed, so the file never has to fit in memory as a whole.
+    Loading an SQLite contacts file moves the contacts into it, see open_database().
+
+    Args:
+        filename (str): The contacts file.
+        background (bool): Load the file in a separate thread and return straight away.
+
+    Returns:
+        loaded (bool): True if the file was loaded, False if it was not found and None if it is not valid.
+    """
+    # Load data from file
+    if not os.path.isfile(filename):
+        print(f"No contacts file was found for '{CONTACTS_FILE}'")
+        return False
+    wait_for_load()
+    return STORAGE.load(filename, background)
+
+@instrumented('load_contents')
+def load_json_contents(filename, show_progress, shard=None):
+    """Stream the contacts from a JSON contacts file into CONTACTS, then replay its journal.
+    The contacts are put in a shard if one is given.
+    """
+    global SNAPSHOT_GENERATION
+    def counted(records):
+        for record in records:
+            if LOAD_PROGRESS['contacts'] == 0:
+                # next_id is written before the contacts, so ids can't be handed out twice while the rest loads
+                reserve_contact_ids(metadata.get('next_id', 0))
+            yield record
+            LOAD_PROGRESS['contacts'] += 1
+            if show_progress and LOAD_PROGRESS['contacts'] % 10000 == 0:
+                print(f"\rLoading '{filename}': {load_percentage()}%", end='', flush=True)
+
+    try:
+        metadata = load_snapshot_cache(filename, shard)
+        if metadata is None:
+            with open(filename, 'r') as f:
+                # Taken from the file being read, as another process may replace the file while it loads
+                key = cache_key(os.fstat(f.fileno()))
+                metadata = {}
+                contacts_dict_to_list(counted(iter_contacts_file(f, filename, metadata)), shard)
+            # Only cache what came from the file, not other files or changes made while loading
+            if SNAPSHOT_CACHE and (JOURNAL_BASE == filename and not PENDING_CHANGES if shard is None else not SHARDS[shard]['changes']):
+                write_snapshot_cache(filename, key, metadata, shard)
+        reserve_contact_ids(metadata.get('next_id', 0))
+        if JOURNAL_BASE == filename:
+            SNAPSHOT_GENERATION = metadata.get('generation', 0)
+        elif shard is not None:
+            SHARDS[shard]['generation'] = metadata.get('generation', 0)
+        replay_journal(filename, metadata.get('generation', 0), shard)
+    except Exception as e:
+        # Check if the file is in the correct format, if not then show an error message and continue without it.
+        # Anything else going wrong must not leave part of the file loaded either.
+        problem = "is not in the correct format" if isinstance(e, (OSError, ValueError, KeyError, TypeError)) else "could not be loaded"
+        print("\n" if show_progress else "", end='')
+        print(f"Error: '{filename}' {problem} ({e!r}), so none of its contacts were loaded.")
+        load_failed(filename, shard)
+        return None
+    finally:
+        LOAD_PROGRESS['done'] = True
+        if show_progress:
+            print()
+    FAILED_LOADS.discard(os.path.abspath(filename))
+    return True
+
+def load_failed(filename, shard=None):
+    """Remove the contacts read from a file before its load failed, and stop the file from being saved over.
+    """
+    with STORE_LOCK:
+        FAILED_LOADS.add(os.path.abspath(filename))
+        if shard is None:
+            set_journal_base(None)
+            PENDING_CHANGES.clear()
+        unload_shard(shard)
+
+def load_failed_before(filename):
+    """Check whether a file failed to load, and say that it won't be saved over if it did.
+    """
+    if os.path.abspath(filename) not in FAILED_LOADS:
+        return False
+    print(f"'{filename}' could not be loaded, so it was not saved over. Fix it and load it again, or export the contacts to another file.")
+    return True
+
+def cache_path(filename):
+    """Get the name of the snapshot cache file for a contacts file.
+    """
+    return filename + '.cache'
+
+def cache_key(stat):
+    """Get the key that a snapshot cache is stored under from the os.stat() of its contacts file.
+    """
+    return (stat.st_mtime_ns, stat.st_size)
+
+def write_snapshot_cache(filename, key, metadata, shard=None):
+    """Write the contacts and search index to the snapshot cache of a contacts file.
+    The contacts of the file (see shard_contacts()) must be exactly the ones in the file that was read,
+    whose cache_key() is key. Nothing is written if the file has been replaced since it was read.
+    Contacts are stored as one list per field and the index as arrays of positions in those lists.
+    """
+    if cache_key(os.stat(filename)) != key:
+        return
+    with STORE_LOCK:
+        flush_index()
+        contacts = shard_contacts(shard)
+        rows = {c: i for i, c in enumerate(contacts)}
+        columns = [[getattr(c, field) for c in contacts] for field in SEARCH_FIELDS]
+        if len(contacts) == len(CONTACTS):
+            index = {gram: array.array('I', [rows[c] for c in postings]).tobytes() for gram, postings in SEARCH_INDEX.items()}
+        else:
+            index = {}
+            for gram, postings in SEARCH_INDEX.items():
+                positions = [rows[c] for c in postings if c in rows]
+                if positions:
+                    index[gram] = array.array('I', positions).tobytes()
+    data = {
+        'version': CACHE_VERSION,
+        'key': key,
+        'metadata': metadata,
+        'columns': columns,
+        'index': index
+    }
+    try:
+        with atomic_write(cache_path(filename), 'wb') as f:
+            marshal.dump(data, f)
+    except (OSError, ValueError):
+        # The cache is only an optimization
+        pass
+
+def load_snapshot_cache(filename, shard=None):
+    """Load contacts from the snapshot cache of a contacts file if it is up to date with the file.
+    The contacts are put in a shard if one is given.
+
+    Returns:
+        metadata (dict): The other top-level values of the contacts file, or None if the cache can't be used.
+    """
+    path = cache_path(filename)
+    if not SNAPSHOT_CACHE or not os.path.isfile(path):
+        return None
+    key = cache_key(os.stat(filename))
+    try:
+        with open(path, 'rb') as f:
+            data = marshal.load(f)
+        if data['version'] != CACHE_VERSION or data['key'] != key:
+            return None
+        contacts = [Contact(*row) for row in zip(*data['columns'])]
+    except (EOFError, ValueError, TypeError, KeyError):
+        return None
+    with STORE_LOCK:
+        store_changed()
+        PREFIX_INDEX.update(built=False, names=[], words=[], pending=[])
+        # Same as add_contact(), but with the search index taken from the cache
+        for c in contacts:
+            c.seq = next(CONTACT_SEQUENCE)
+            c.shard = shard
+            CONTACTS.append(c)
+            register_id(c)
+            register_memberships(c)
+            index_keys(c)
+        if shard is not None:
+            SHARDS[shard]['contacts'].update(dict.fromkeys(contacts))
+        for gram, rows in data['index'].items():
+            postings = SEARCH_INDEX.get(gram)
+            if postings is None:
+                postings = SEARCH_INDEX[gram] = set()
+            postings.update(map(contacts.__getitem__, array.array('I', rows)))
+    LOAD_PROGRESS.update(contacts=len(contacts), read=LOAD_PROGRESS['size'])
+    return data['metadata']
+
+def load_percentage():
+    """Get roughly how much of the file being loaded has been read.
+    """
+    if LOAD_PROGRESS['size'] == 0:
+        return 100
+    return min(100, LOAD_PROGRESS['read'] * 100 // LOAD_PROGRESS['size'])
+
+def wait_for_load(quiet=False):
+    """Block until a background load has finished.
+    """
+    if LOADER is not None and LOADER.is_alive():
+        if not quiet:
+            print(f"Waiting for '{LOAD_PROGRESS['filename']}' to finish loading...")
+        LOADER.join()
+
+def journal_path(filename):
+    """Get the name of the journal file for a contacts file.
+    """
+    return filename + '.journal'
+
+def set_journal_base(filename):
+    """Set the contacts file that the contacts in memory match, apart from PENDING_CHANGES.
+    """
+    global JOURNAL_BASE, JOURNAL_SIZE, FILE_VERSION
+    JOURNAL_BASE = filename
+    JOURNAL_SIZE = 0
+    FILE_VERSION = None if filename is None else file_version(filename)
+
+def file_version(filename):
+    """Get a version of a contacts file and its journal that changes whenever either of them is written.
+    """
+    version = []
+    for path in (filename, journal_path(filename)):
+        try:
+            stat = os.stat(path)
+            version.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """Hold an advisory lock on '<filename>.lock' so only one process saves a contacts file at a time.
+    """
+    with open(filename + '.lock', 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+@contextlib.contextmanager
+def atomic_write(filename, mode='w', newline=None):
+    """Write a file by writing a temporary file next to it and renaming it over the file once it is
+    on disk, so a crash while writing leaves the old file as it was.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', suffix='.tmp', dir=directory)
+    try:
+        os.chmod(temp, os.stat(filename).st_mode & 0o777 if os.path.isfile(filename) else 0o644)
+        with os.fdopen(fd, mode, newline=newline) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, filename)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+def merge_saved_contents(filename):
+    """Reload a contacts file that another process has saved since it was loaded, and apply the
+    unsaved changes on top of it. Changes to contacts the other process also changed are not applied.
+
+    Returns:
+        merged (bool): False if the saved file could not be loaded.
+    """
+    changes = list(PENDING_CHANGES)
+    print(f"'{filename}' was saved by someone else, merging changes...")
+    unload_shard(None)
+    if not load_contents(filename):
+        return False
+    conflicts = merge_changes(changes)
+    if conflicts:
+        print(f"{len(conflicts)} changes were not applied because the same contacts were changed in the saved file:")
+        for change in conflicts:
+            print(f"    {change['op']} {change['contact']['id'] if 'contact' in change else change['id']}")
+    return True
+
+def merge_changes(changes):
+    """Apply changes made to an older version of the contacts, unless the contact they change is different now.
+
+    Args:
+        changes (list): The changes, as recorded for the journal.
+
+    Returns:
+        conflicts (list): The changes that were not applied.
+    """
+    conflicts = []
+    # New ids given to added contacts whose id was also given out by the other process
+    renamed = {}
+    for change in changes:
+        op = change['op']
+        if op == 'add':
+            fields = change['contact']
+            if fields['id'] in CONTACTS_BY_ID:
+                renamed[fields['id']] = generate_contact_id()
+                fields = dict(fields, id=renamed[fields['id']])
+            add_contact(Contact(**fields))
+        elif op == 'remove':
+            fields = dict(change['contact'], id=renamed.get(change['contact']['id'], change['contact']['id']))
+            c = find_contact(fields)
+            if c is not None:
+                remove_contact(c)
+            elif shard_contact(fields['id']) is not None:
+                conflicts.append(change)
+        elif op == 'fix':
+            # Not fix(), which waits for the load this may be part of
+            STORAGE.fix()
+        else:
+            recorded = dict(change['contact'], id=renamed.get(change['contact']['id'], change['contact']['id']))
+            c = merge_target(recorded)
+            if c is None:
+                conflicts.append(change)
+            elif op == 'edit':
+                current = contact_to_dict(c)
+                new = contact_to_dict(Contact(**dict(current, **change['fields'])))
+                if any(current[f] != recorded[f] and current[f] != new[f] for f in change['fields']):
+                    conflicts.append(change)
+                else:
+                    update_contact(c, **change['fields'])
+            elif op == 'group_add':
+                add_to_group(change['group'], c)
+            elif op == 'group_remove':
+                remove_from_group(change['group'], c)
+    return conflicts
+
+def merge_target(contact_dict):
+    """Find the contact that an edit or group change made before a merge applies to.
+    The other process may have changed it too, so if no contact matches the one recorded with the
+    change exactly, the contact with its id and name, or failing that the one with the most fields
+    in common with it, is used.
+
+    Returns:
+        contact (Contact): The contact, or None if there is no contact with the id or the contacts sharing it can't be told apart.
+    """
+    c = find_contact(contact_dict)
+    if c is not None:
+        return c
+    scored = []
+    for c in [CONTACTS_BY_ID.get(contact_dict['id'])] + DUPLICATE_IDS.get(contact_dict['id'], []):
+        if c is not None and c.shard is None:
+            fields = contact_to_dict(c)
+            scored.append(((fields['name'] == contact_dict['name'], sum(value == contact_dict[field] for field, value in fields.items())), c))
+    scored.sort(key=lambda s: s[0], reverse=True)
+    if not scored or (len(scored) > 1 and scored[0][0] == scored[1][0]):
+        return None
+    return scored[0][1]
+
+def replay_journal(filename, generation, shard=None):
+    """Apply the changes in the journal of a contacts file.
+    A journal written for an older version of the contacts file is ignored, as are
+    any incomplete changes left at the end of it by a crash.
+
+    Args:
+        filename (str): The contacts file.
+        generation (int): The generation of the contacts file that was loaded.
+        shard (str): The shard the file was loaded into, if any.
+    """
+    global JOURNAL_SIZE
+    path = journal_path(filename)
+    if not os.path.isfile(path):
+        return
+    with open(path, 'rb') as f:
+        try:
+            header = json.loads(f.readline())
+        except JSONDecodeError:
+            return
+        if header.get('generation') != generation:
+            return
+        end = f.tell()
+        for line in f:
+            try:
+                change = json.loads(line)
+            except JSONDecodeError:
+                break
+            apply_change(change, shard)
+            end += len(line)
+            if JOURNAL_BASE == filename:
+                JOURNAL_SIZE += 1
+            elif shard is not None:
+                SHARDS[shard]['journal_size'] += 1
+    if end < os.path.getsize(path):
+        # Cut off the incomplete change so later changes are appended after the last good one
+        with open(path, 'r+b') as f:
+            f.truncate(end)
+
+def apply_change(change, shard=None):
+    """Apply a change read from a journal to the contacts of a file.
+    """
+    op = change['op']
+    if op == 'add':
+        contacts_dict_to_list([change['contact']], shard)
+    elif op == 'remove':
+        c = find_contact(change['contact'], shard)
+        if c is not None:
+            remove_contact(c, record=False)
+    elif op == 'fix':
+        # Not fix(), which would wait for the load replaying the journal, from the loader thread itself
+        STORAGE.fix(record=False)
+    else:
+        c = changed_contact(change, shard)
+        if c is None:
+            return
+        if op == 'edit':
+            update_contact(c, record=False, **change['fields'])
+        elif op == 'group_add':
+            add_to_group(change['group'], c, record=False)
+        elif op == 'group_remove':
+            remove_from_group(change['group'], c, record=False)
+
+def changed_contact(change, shard=None):
+    """Find the contact an edit or group change applies to.
+    Changes hold the whole contact as it was before the change, so contacts sharing an id are told
+    apart. Journals written before that only have the id.
+    """
+    if 'contact' in change:
+        return find_contact(change['contact'], shard)
+    return shard_contact(change['id'], shard)
+
+def find_contact(contact_dict, shard=None):
+    """Find the contact of a file matching a contact dictionary, checking every contact that shares its id.
+    """
+    c = CONTACTS_BY_ID.get(contact_dict['id'])
+    for candidate in [c] + DUPLICATE_IDS.get(contact_dict['id'], []):
+        if candidate is not None and candidate.shard == shard and contact_to_dict(candidate) == contact_dict:
+            return candidate
+    return None
+
+def shard_contact(id, shard=None):
+    """Get the first contact with an id in a shard, or in the contacts file for None.
+    """
+    for c in [CONTACTS_BY_ID.get(id)] + DUPLICATE_IDS.get(id, []):
+        if c is not None and c.shard == shard:
+            return c
+    return None
+
+@instrumented('save_contents')
+def save_contents(filename):
+    """Save the contacts file to a JSON file.
+    In journal mode, saving to the file the contacts were loaded from only appends the changes
+    made since the last save to its journal. If another process has saved that file since, its
+    changes are merged in first.
+    """
+    wait_for_load()
+    if load_failed_before(filename):
+        return
+    if is_saved(filename):
+        return
+    STORAGE.save(filename)
+
+def append_journal(filename, generation, changes):
+    """Append changes to the journal of a contacts file, starting the journal if there isn't one.
+
+    Args:
+        filename (str): The contacts file.
+        generation (int): The generation of the contacts file, written at the start of a new journal.
+        changes (list): The changes, as recorded by record_change().
+    """
+    new_journal = not os.path.isfile(journal_path(filename))
+    with open(journal_path(filename), 'a') as f:
+        if new_journal:
+            f.write(json.dumps({'generation': generation}) + '\n')
+        for change in changes:
+            f.write(json.dumps(change, separators=(',', ':')) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def write_json_contacts(filename, contacts, metadata):
+    """Write contacts to a JSON contacts file one at a time, without building the whole document first.
+    NDJSON contacts files are written as NDJSON, and JSON ones are indented unless COMPACT_JSON is set.
+
+    Args:
+        filename (str): The file to write.
+        contacts (iterable): The contacts.
+        metadata (dict): Other top-level values to write before the contacts.
+    """
+    with atomic_write(filename) as f:
+        if is_ndjson_file(filename):
+            write_ndjson_contacts(f, contacts, metadata)
+            return
+        if COMPACT_JSON:
+            f.write("{" + "".join(f"{json.dumps(key)}:{json.dumps(value)}," for key, value in metadata.items()) + '"contacts":[')
+            separator = "\n"
+            for contact in contacts:
+                f.write(separator)
+                f.write(json.dumps(contact_to_dict(contact), separators=(',', ':')))
+                separator = ",\n"
+            f.write("\n]}")
+            return
+        f.write("{\n")
+        for key, value in metadata.items():
+            f.write(f"    {json.dumps(key)}: {json.dumps(value)},\n")
+        f.write('    "contacts": [')
+        separator = "\n"
+        for contact in contacts:
+            f.write(separator)
+            f.write(json.dumps(contact_to_dict(contact), indent=4).replace("\n", "\n        ").replace("{", "        {", 1))
+            separator = ",\n"
+        f.write("\n    ]\n}")
+
+def compact(filename):
+    """Write all contacts to the contacts file and delete its journal.
+    """
+    wait_for_load()
+    if load_failed_before(filename):
+        return
+    with STORE_LOCK, file_lock(filename):
+        if filename == JOURNAL_BASE and os.path.isfile(filename) and file_version(filename) != FILE_VERSION:
+            if not merge_saved_contents(filename):
+                return
+        write_snapshot(filename)
+
+def write_snapshot(filename):
+    """Write the contacts to a JSON file: only those of the contacts file if it is the contacts file, otherwise every contact.
+    """
+    global SNAPSHOT_GENERATION
+    with STORE_LOCK:
+        generation = SNAPSHOT_GENERATION + 1
+        main = filename == CONTACTS_FILE or filename == JOURNAL_BASE
+        write_json_contacts(filename, shard_contacts(None) if main else CONTACTS, {'generation': generation, 'next_id': NEXT_CONTACT_ID})
+        if os.path.isfile(journal_path(filename)):
+            os.remove(journal_path(filename))
+        if main:
+            SNAPSHOT_GENERATION = generation
+            PENDING_CHANGES.clear()
+            set_journal_base(filename)
+
+def shard_contacts(shard):
+    """Get the contacts of a shard, or of the contacts file for None, in the order they were added.
+    """
+    if shard is not None:
+        return list(SHARDS[shard]['contacts'])
+    if not SHARDS:
+        return CONTACTS
+    return [c for c in CONTACTS if c.shard is None]
+
+def same_file(a, b):
+    """Check whether two filenames name the same file.
+    """
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return os.path.abspath(a) == os.path.abspath(b)
+
+def find_shard(filename):
+    """Get the name of the loaded shard that is a file, or None if it is not loaded.
+    """
+    for shard in SHARDS:
+        if same_file(shard, filename):
+            return shard
+    return None
+
+def load_shard(filename):
+    """Load a contacts file as a shard. Its contacts are searched with the rest, but are only ever
+    saved back to it. A shard that is already loaded is loaded again, replacing its contacts.
+
+    Returns:
+        loaded (bool): True if the file was loaded, False if it was not found and None if it can't be loaded.
+    """
+    if not os.path.isfile(filename):
+        print(f"No contacts file was found for '{filename}'")
+        return False
+    if same_file(filename, CONTACTS_FILE) or (JOURNAL_BASE is not None and same_file(filename, JOURNAL_BASE)):
+        print(f"'{filename}' is already loaded as the contacts file.")
+        return None
+    wait_for_load()
+    with STORE_LOCK:
+        if find_shard(filename) is not None:
+            unload_shard(find_shard(filename))
+        SHARDS[filename] = {'contacts': {}, 'changes': [], 'version': file_version(filename), 'generation': 0, 'journal_size': 0}
+    LOAD_PROGRESS.update(filename=filename, contacts=0, read=0, size=os.path.getsize(filename), done=False)
+    return load_json_contents(filename, LOAD_PROGRESS['size'] > BACKGROUND_LOAD_SIZE, filename)
+
+def unload_shard(shard):
+    """Remove every contact of a shard, or of the contacts file for None, without recording the changes.
+    """
+    with STORE_LOCK:
+        if shard is None and not SHARDS:
+            clear_contacts()
+            return
+        store_changed()
+        flush_index()
+        removed = SHARDS.pop(shard)['contacts'] if shard is not None else dict.fromkeys(shard_contacts(None))
+        for c in removed:
+            unregister_id(c)
+            unindex_contact(c)
+            unregister_memberships(c)
+        CONTACTS[:] = [c for c in CONTACTS if c not in removed]
+
+def save_shard(shard):
+    """Save the changes to a shard to its file, unless someone else has changed the file since it was loaded.
+    In journal mode the changes are appended to the file's journal, otherwise the file is rewritten.
+
+    Returns:
+        saved (bool): True if the shard was saved.
+    """
+    with STORE_LOCK, file_lock(shard):
+        state = SHARDS[shard]
+        if file_version(shard) != state['version']:
+            print(f"'{shard}' was changed by someone else since it was loaded, so it was not saved. "
+                  f"Use 'export' to save a copy of the changes, or 'load {shard}' to discard them.")
+            return False
+        if JOURNAL_MODE and state['journal_size'] + len(state['changes']) < JOURNAL_COMPACT_SIZE:
+            append_journal(shard, state['generation'], state['changes'])
+            state['journal_size'] += len(state['changes'])
+        else:
+            state['generation'] += 1
+            write_json_contacts(shard, state['contacts'], {'generation': state['generation'], 'next_id': NEXT_CONTACT_ID})
+            if os.path.isfile(journal_path(shard)):
+                os.remove(journal_path(shard))
+            state['journal_size'] = 0
+        state.update(changes=[], version=file_version(shard))
+        return True
+
+def read_csv_contacts(f):
+    """Read contacts from a CSV file with a header row naming the contact fields.
+    Columns are matched to fields ignoring case, other columns are ignored, and groups are separated by ';'
+    (written as '\\;' when it is part of a group name).
+    """
+    reader = csv.reader(f)
+    header = [name.strip().lower() for name in next(reader, [])]
+    for row in reader:
+        if not any(row):
+            continue
+        record = {field: value for field, value in zip(header, row) if field in SEARCH_FIELDS}
+        record['groups'] = [g.strip() for g in vcard_split(record.get('groups', ''), ';') if g.strip()]
+        yield record
+
+def write_csv_contacts(f, contacts):
+    writer = csv.writer(f)
+    writer.writerow(SEARCH_FIELDS)
+    for contact in contacts:
+        groups = ";".join(g.replace('\\', '\\\\').replace(';', '\\;') for g in contact.groups)
+        writer.writerow((contact.id, contact.name, contact.phone, contact.email, contact.company, contact.notes, groups))
+
+def read_ndjson_contacts(f, metadata=None):
+    """Read contacts from a file with one JSON object of contact fields on each line.
+    A first line of {"metadata": {...}}, as written to NDJSON contacts files, is not a contact.
+
+    Args:
+        f (file): The open file.
+        metadata (dict): If given, the values in the metadata line are stored in it.
+
+    Raises:
+        ValueError: If a line is not a JSON object.
+    """
+    for number, line in enumerate(f):
+        LOAD_PROGRESS['read'] += len(line)
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if type(record) != dict:
+            raise ValueError(f"Line {number + 1} is not a JSON object")
+        if number == 0 and list(record) == ['metadata']:
+            if metadata is not None:
+                metadata.update(record['metadata'])
+            continue
+        yield record
+
+def write_ndjson_contacts(f, contacts, metadata=None):
+    """Write contacts with one JSON object of contact fields on each line, after a line of metadata if given.
+    """
+    if metadata is not None:
+        f.write(json.dumps({'metadata': metadata}, separators=(',', ':')) + "\n")
+    for contact in contacts:
+        f.write(json.dumps(contact_to_dict(contact), separators=(',', ':')) + "\n")
+
+# vCard properties of each contact field
+VCARD_PROPERTIES = {'UID': 'id', 'FN': 'name', 'TEL': 'phone', 'EMAIL': 'email', 'ORG': 'company', 'NOTE': 'notes', 'CATEGORIES': 'groups'}
+
+def vcard_escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace(',', '\\,').replace(';', '\\;')
+
+def vcard_split(value, separator):
+    """Split a vCard value on a separator that isn't escaped with a backslash, and unescape the parts.
+    """
+    parts = ['']
+    escaped = False
+    for ch in value:
+        if escaped:
+            parts[-1] += '\n' if ch in 'nN' else ch
+            escaped = False
+        elif ch == '\\':
+            escaped = True
+        elif ch == separator:
+            parts.append('')
+        else:
+            parts[-1] += ch
+    return parts
+
+def read_vcard_contacts(f):
+    """Read contacts from a vCard file. Only the first value of each property is used, and the
+    name is taken from N when there is no FN.
+    """
+    def unfolded(lines):
+        # Lines starting with a space or tab continue the line before
+        line = None
+        for next_line in lines:
+            next_line = next_line.rstrip('\r\n')
+            if next_line[:1] in (' ', '\t') and line is not None:
+                line += next_line[1:]
+                continue
+            if line is not None:
+                yield line
+            line = next_line
+        if line is not None:
+            yield line
+
+    record = None
+    for line in unfolded(f):
+        name, sep, value = line.partition(':')
+        if not sep:
+            continue
+        # Drop parameters (TEL;TYPE=cell) and group prefixes (item1.EMAIL)
+        prop = name.split(';')[0].split('.')[-1].upper()
+        if prop == 'BEGIN' and value.upper() == 'VCARD':
+            record = {'groups': []}
+        elif record is None:
+            continue
+        elif prop == 'END':
+            yield record
+            record = None
+        elif prop == 'CATEGORIES':
+            record['groups'] += [g.strip() for g in vcard_split(value, ',') if g.strip()]
+        elif prop == 'N' and 'name' not in record:
+            # Family;Given;Additional;Prefix;Suffix
+            parts = vcard_split(value, ';') + [''] * 5
+            record['name'] = " ".join(p for p in (parts[3], parts[1], parts[2], parts[0], parts[4]) if p)
+        elif prop in VCARD_PROPERTIES and (VCARD_PROPERTIES[prop] not in record or prop == 'FN'):
+            # Structured values (ORG:Company;Department) are separated by ';', only the first part is used
+            record[VCARD_PROPERTIES[prop]] = vcard_split(value, ';')[0]
+
+def write_vcard_contacts(f, contacts):
+    for contact in contacts:
+        lines = ["BEGIN:VCARD", "VERSION:3.0"]
+        for prop, field in VCARD_PROPERTIES.items():
+            if field == 'groups':
+                if contact.groups:
+                    lines.append("CATEGORIES:" + ",".join(vcard_escape(g) for g in contact.groups))
+            elif getattr(contact, field) or prop == 'FN':
+                lines.append(f"{prop}:{vcard_escape(getattr(contact, field))}")
+        lines.append("END:VCARD")
+        f.write("\r\n".join(lines) + "\r\n")
+
+# Import and export formats: the reader, which yields dictionaries of contact fields, and the
+# writer, which writes contacts as they come. A format is picked by the file's extension unless
+# it is named with --format.
+CONTACT_FORMATS = {
+    'csv': (read_csv_contacts, write_csv_contacts),
+    'ndjson': (read_ndjson_contacts, write_ndjson_contacts),
+    'vcard': (read_vcard_contacts, write_vcard_contacts)
+}
+FORMAT_EXTENSIONS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.vcf': 'vcard', '.vcard': 'vcard'}
+
+def file_format(filename, format=None):
+    """Get the import and export format of a file.
+
+    Returns:
+        format (str): The name of the format in CONTACT_FORMATS, or None if the file isn't in one of them.
+    """
+    if format is not None:
+        return format if format in CONTACT_FORMATS else None
+    return FORMAT_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+def import_contacts(filename, format):
+    """Add the contacts in a CSV, vCard or NDJSON file to the contacts.
+    Records are read and added one at a time, and indexed together at the end. Records without an
+    id are given a new one.
+
+    Returns:
+        imported (int): The number of contacts added.
+    """
+    reader = CONTACT_FORMATS[format][0]
+    wait_for_load()
+    imported = 0
+
+    def contacts(records):
+        nonlocal imported
+        for record in records:
+            imported += 1
+            yield contact_from_record(record)
+
+    with open(filename, 'r', newline='' if format == 'csv' else None, encoding='utf-8') as f:
+        STORAGE.add_many(contacts(reader(f)))
+    return imported
+
+def contact_from_record(record):
+    """Make a contact from a dictionary of imported contact fields. Missing fields are left empty.
+    """
+    groups = record.get('groups') or []
+    return Contact(str(record.get('id') or generate_contact_id()), str(record.get('name') or ''), str(record.get('phone') or ''),
+                   str(record.get('email') or ''), str(record.get('company') or ''), str(record.get('notes') or ''),
+                   [str(g) for g in groups] if type(groups) == list else [g.strip() for g in str(groups).split(';') if g.strip()])
 
-    def __str__(self):
-        return f"{self.name} ({self.phone})"
+def export_contacts(filename, format):
+    """Write every contact to a CSV, vCard or NDJSON file, one contact at a time.
 
-def print_contacts(cts):
-    """Print the contacts in a list. With column headers and tabs in between
+    Returns:
+        exported (int): The number of contacts written.
     """
-    print("\n{:<10}{:<20}{:<20}{:<20}{:<20}{:<20}{:<20}".format("ID", "Name", "Phone", "Email", "Company", "Notes", "Groups"))
-    for ct in cts:
-        print("{:<10}{:<20}{:<20}{:<20}{:<20}{:<20}".format(ct.id, ct.name, ct.phone, ct.email, ct.company, ct.notes, ct.groups))
-    print("\n")
+    writer = CONTACT_FORMATS[format][1]
+    wait_for_load()
+    exported = 0
 
-def print_companies():
-    """Print the companies in a list and the number of contacts per company.
+    def counted(contacts):
+        nonlocal exported
+        for contact in contacts:
+            exported += 1
+            yield contact
+
+    with STORE_LOCK, atomic_write(filename, newline='' if format == 'csv' else None) as f:
+        writer(f, counted(STORAGE.contacts()))
+    return exported
+
+def is_sqlite_file(filename):
+    """Check whether a contacts file is an SQLite database, going by its extension.
     """
-    print("\n{:<20}{:<20}".format("Company", "# of Contacts"))
-    for c in COMPANIES:
-        print("{:<20}{:<20}".format(c, len(COMPANIES[c])))
+    return os.path.splitext(filename)[1].lower() in SQLITE_EXTENSIONS
 
-def print_groups():
-    """Print the groups in a list and the number of contacts per group.
+@instrumented('load_contents')
+def open_database(filename):
+    """Open an SQLite contacts file as STORAGE, moving any contacts already in memory into it.
     """
-    print("\n{:<20}{:<20}".format("Group", "# of Contacts"))
-    for g in GROUPS:
-        print("{:<20}{:<20}".format(g, len(GROUPS[g])))
+    global STORAGE
+    store_changed()
+    STORAGE = SqliteStorage(filename)
+    set_journal_base(None)
+    if CONTACTS:
+        STORAGE.add_many(CONTACTS)
+        clear_contacts()
+    return True
 
-def get_contact_by_id(id):
-    """Get a contact by id.
+def export_to_sqlite(filename):
+    """Write every contact to a new SQLite database.
+    """
+    contacts = STORAGE.contacts()
+    if os.path.isfile(filename):
+        os.remove(filename)
+    database = SqliteStorage(filename)
+    database.add_many(contacts)
+    database.commit()
+    database.close()
 
-    Args:
-        id (str): The identifier of the contact.
+def sqlite_regexp(pattern, value):
+    """The REGEXP function for SQLite queries. Case is ignored.
+    """
+    return value is not None and re.search(pattern, value, re.IGNORECASE) is not None
 
-    Returns:
-        contact (Contact): The contact object.
+class MemoryStorage:
+    """Contacts kept in memory, in CONTACTS and the indexes built from it, and loaded from and saved to
+    JSON contacts files. Files loaded on top of the contacts file are kept as shards, and changes are
+    recorded for the journal and for merging unless record is False. The default STORAGE.
     """
-    if type(id) == list:
-        results = []
-        for ct in id:
-            results.append(get_contact_by_id(ct))
-        return results
-    for ct in CONTACTS:
-        if ct.id == id:
-            return ct
-    return None
+    SINGLE_THREADED = False
 
-def yorn_prompt(prompt, default="y", show_proceed=True):
-    print(prompt)
-    default = {"y": True, "n": False}[default.lower()]
-    while True:
-        print("{}({}/{})? ".format("Proceed " if show_proceed else "", "[y]" if default else "y", "[n]" if not default else "n"), end="")
-        response = input().lower()
-        if response == "":
-            return default
-        elif response[0] == "y":
+    @property
+    def changes(self):
+        """The number of changes made since the contacts were loaded or last saved.
+        """
+        return len(PENDING_CHANGES) + sum(len(shard['changes']) for shard in SHARDS.values())
+
+    def add(self, contact, record=True):
+        with STORE_LOCK:
+            store_changed()
+            contact.seq = next(CONTACT_SEQUENCE)
+            CONTACTS.append(contact)
+            if contact.shard is not None:
+                SHARDS[contact.shard]['contacts'][contact] = None
+            register_id(contact)
+            if INDEXING_DEFERRED:
+                PENDING_INDEX[contact] = None
+            else:
+                index_contact(contact)
+                register_memberships(contact)
+            if record:
+                record_change({'op': 'add', 'contact': contact_to_dict(contact)}, contact)
+
+    def add_many(self, contacts):
+        """Add contacts, indexing them together at the end.
+        """
+        defer_indexing(True)
+        try:
+            for contact in contacts:
+                self.add(contact)
+        finally:
+            defer_indexing(False)
+
+    def remove(self, contact, record=True):
+        with STORE_LOCK:
+            store_changed()
+            CONTACTS.remove(contact)
+            if contact.shard is not None:
+                del SHARDS[contact.shard]['contacts'][contact]
+            unregister_id(contact)
+            if contact in PENDING_INDEX:
+                del PENDING_INDEX[contact]
+            else:
+                unindex_contact(contact)
+                unregister_memberships(contact)
+            if record:
+                record_change({'op': 'remove', 'contact': contact_to_dict(contact)}, contact)
+
+    def update(self, contact, fields, record=True):
+        with STORE_LOCK:
+            store_changed()
+            if record:
+                old = contact_to_dict(contact)
+                record_change({'op': 'edit', 'id': contact.id, 'contact': old, 'fields': fields}, contact)
+            pending = contact in PENDING_INDEX
+            if not pending:
+                unindex_contact(contact)
+                unregister_memberships(contact)
+            if 'id' in fields:
+                unregister_id(contact)
+            for field, value in fields.items():
+                setattr(contact, field, value)
+            if 'id' in fields:
+                register_id(contact)
+            if not pending:
+                index_contact(contact)
+                register_memberships(contact)
+
+    def add_to_group(self, group_name, contact, record=True):
+        with STORE_LOCK:
+            if group_name in contact.groups:
+                return False
+            old = contact_to_dict(contact)
+            self.update(contact, {'groups': contact.groups + (group_name,)}, record=False)
+            if record:
+                record_change({'op': 'group_add', 'group': group_name, 'id': contact.id, 'contact': old}, contact)
             return True
-        elif response[0] == "n":
+
+    def remove_from_group(self, group_name, contact, record=True):
+        with STORE_LOCK:
+            if group_name not in contact.groups:
+                return False
+            old = contact_to_dict(contact)
+            self.update(contact, {'groups': [g for g in contact.groups if g != group_name]}, record=False)
+            if record:
+                record_change({'op': 'group_remove', 'group': group_name, 'id': contact.id, 'contact': old}, contact)
+            return True
+
+    def get(self, id):
+        return CONTACTS_BY_ID.get(id)
+
+    def lookup(self, field, key):
+        with STORE_LOCK:
+            flush_index()
+            results = list((PHONE_INDEX if field == 'phone' else EMAIL_INDEX).get(key, ()))
+        results.sort(key=lambda c: c.seq)
+        return results
+
+    def search(self, predicates):
+        with STORE_LOCK:
+            flush_index()
+            if len(predicates) == 1 and predicates[0][0] == 'all':
+                return search_index(predicates[0][1].lower())
+            return plan_search(predicates)
+
+    def scan(self, kind, pattern, fields):
+        """Check every contact, in parallel for large stores when PARALLEL_SCAN is on.
+        Worker processes are forked so they can read CONTACTS without it being copied to them.
+        Where fork is not available, there is only one CPU or other threads are running (which the
+        forked processes could deadlock on), the scan runs in this process.
+        """
+        if kind == 'regex':
+            pattern = re.compile(pattern, re.IGNORECASE)
+        with STORE_LOCK:
+            flush_index()
+            count = len(CONTACTS)
+            # The scan is CPU bound, so more processes than CPUs only add the cost of forking them
+            workers = min(SCAN_WORKERS, os.cpu_count() or 1, count // (PARALLEL_SCAN_THRESHOLD // 4 or 1))
+            if (not PARALLEL_SCAN or count < PARALLEL_SCAN_THRESHOLD or workers < 2 or threading.active_count() > 1
+                    or 'fork' not in multiprocessing.get_all_start_methods()):
+                return [CONTACTS[i] for i in scan_shard(0, count, kind, pattern, fields)]
+            # Use a few shards per worker so one slow shard doesn't hold up the rest
+            size = -(-count // (workers * 4))
+            # STORE_LOCK stays held so the workers see CONTACTS as it is now. They only read CONTACTS and
+            # never take a lock, so the copies of locks they inherit don't matter.
+            context = multiprocessing.get_context('fork')
+            with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context) as pool:
+                shards = [pool.submit(scan_shard, start, min(start + size, count), kind, pattern, fields) for start in range(0, count, size)]
+                return [CONTACTS[i] for shard in shards for i in shard.result()]
+
+    def ranked_search(self, search_terms, value, k):
+        """Find the best matches for a plain search term from the indexes, see ranked_search().
+        """
+        term = value.lower().strip()
+        with STORE_LOCK:
+            flush_index()
+            update_prefix_index()
+            exact = {}
+            for c in [CONTACTS_BY_ID.get(value.strip())] + DUPLICATE_IDS.get(value.strip(), []):
+                if c is not None:
+                    exact[c] = None
+            exact.update(dict.fromkeys(entry[2] for entry in itertools.takewhile(lambda e: e[0] == term, prefix_matches('names', term))))
+            exact.update(dict.fromkeys(EMAIL_INDEX.get(email_key(term), ())))
+            if phone_key(term):
+                exact.update(dict.fromkeys(PHONE_INDEX.get(phone_key(term), ())))
+            for members in (COMPANIES, GROUPS):
+                for name in members:
+                    if name.lower() == term:
+                        exact.update(members[name])
+            results = best_matches(exact, term, k)
+            if len(results) == k:
+                return results
+            # A name starting with the term beats every other field that isn't an exact match
+            for which in ('names', 'words'):
+                for entry in prefix_matches(which, term):
+                    if entry[2] not in exact:
+                        exact[entry[2]] = None
+                        results.append(entry[2])
+                        if len(results) == k:
+                            return results
+            return best_matches(set(search(search_terms)) | exact.keys(), term, k)
+
+    def count(self):
+        return len(CONTACTS)
+
+    def contacts(self, offset=0, limit=None):
+        return CONTACTS[offset:None if limit is None else offset + limit]
+
+    def company_counts(self):
+        return {c: len(COMPANIES[c]) for c in COMPANIES}
+
+    def group_counts(self):
+        return {g: len(GROUPS[g]) for g in GROUPS}
+
+    def fix(self, record=True):
+        with STORE_LOCK:
+            store_changed()
+            flush_index()
+            duplicates = set()
+            for id, contacts in DUPLICATE_IDS.items():
+                shards = {CONTACTS_BY_ID[id].shard}
+                for c in contacts:
+                    if c.shard in shards:
+                        duplicates.add(c)
+                    shards.add(c.shard)
+            if duplicates:
+                for c in duplicates:
+                    unregister_id(c)
+                    unindex_contact(c)
+                    unregister_memberships(c)
+                    if c.shard is not None:
+                        del SHARDS[c.shard]['contacts'][c]
+                CONTACTS[:] = [c for c in CONTACTS if c not in duplicates]
+                if record:
+                    # Once for each file that had duplicates
+                    for c in {c.shard: c for c in duplicates}.values():
+                        record_change({'op': 'fix'}, c)
+
+    def is_saved(self, filename):
+        if filename in SHARDS:
+            return not SHARDS[filename]['changes']
+        if filename == CONTACTS_FILE and any(shard['changes'] for shard in SHARDS.values()):
             return False
+        return filename == JOURNAL_BASE and not PENDING_CHANGES and os.path.isfile(filename)
+
+    def load(self, filename, background=False):
+        """Load a JSON contacts file, or open an SQLite one.
+        """
+        global LOADER
+        if is_sqlite_file(filename):
+            return open_database(filename)
+        if len(CONTACTS) > sum(len(shard['contacts']) for shard in SHARDS.values()):
+            # Added to contacts that aren't in the file, so it can't be journaled
+            set_journal_base(None)
         else:
-            print("Invalid choice: {}".format(response))
+            set_journal_base(filename)
+            PENDING_CHANGES.clear()
+        LOAD_PROGRESS.update(filename=filename, contacts=0, read=0, size=os.path.getsize(filename), done=False)
+        if background:
+            LOADER = threading.Thread(target=load_json_contents, args=(filename, False), daemon=True)
+            LOADER.start()
+            return True
+        return load_json_contents(filename, LOAD_PROGRESS['size'] > BACKGROUND_LOAD_SIZE)
 
-def search(search_terms, fields = 'all', advanced=False):
-    """Search for a contact.
+    def save(self, filename):
+        """Save to a JSON contacts file, or write every contact to a new SQLite one.
+        """
+        global JOURNAL_SIZE, FILE_VERSION
+        if is_sqlite_file(filename):
+            export_to_sqlite(filename)
+            return
+        if filename in SHARDS:
+            save_shard(filename)
+            return
+        if filename == CONTACTS_FILE:
+            for shard in list(SHARDS):
+                if SHARDS[shard]['changes']:
+                    save_shard(shard)
+            if is_saved(filename):
+                return
+        with STORE_LOCK, file_lock(filename):
+            if filename == JOURNAL_BASE and os.path.isfile(filename) and file_version(filename) != FILE_VERSION:
+                if not merge_saved_contents(filename):
+                    return
+            if JOURNAL_MODE and filename == JOURNAL_BASE and os.path.isfile(filename):
+                if not PENDING_CHANGES:
+                    return
+                append_journal(filename, SNAPSHOT_GENERATION, PENDING_CHANGES)
+                JOURNAL_SIZE += len(PENDING_CHANGES)
+                FILE_VERSION = file_version(filename)
+                PENDING_CHANGES.clear()
+                if JOURNAL_SIZE >= JOURNAL_COMPACT_SIZE:
+                    write_snapshot(filename)
+                return
+            write_snapshot(filename)
 
-    Args:
-        search_term (str): The search term to search for.
-    
-    Returns:
-        results (list): A list of contacts that match the search term.
+    def close(self):
+        pass
+
+STORAGE = MemoryStorage()
+
+class SqliteStorage:
+    """Contacts kept in an SQLite database instead of in memory.
+    Only the contacts a command asks for are read from the database. Substring searches use an
+    FTS5 trigram index when SQLite supports it. Changes stay in a transaction until 'save'
+    commits them, so exiting without saving discards them, the same as with a JSON file, and
+    nothing is recorded for a journal (record is ignored).
     """
+    # An SQLite connection can only be used by the thread that opened it
+    SINGLE_THREADED = True
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS contacts (
+            seq INTEGER PRIMARY KEY,
+            id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            email TEXT NOT NULL,
+            company TEXT NOT NULL,
+            notes TEXT NOT NULL,
+            group_names TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS contacts_id ON contacts(id);
+        CREATE INDEX IF NOT EXISTS contacts_company ON contacts(company);
+        CREATE TABLE IF NOT EXISTS memberships (contact INTEGER NOT NULL, grp TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS memberships_grp ON memberships(grp);
+        CREATE INDEX IF NOT EXISTS memberships_contact ON memberships(contact);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+        CREATE TRIGGER IF NOT EXISTS contacts_delete_memberships AFTER DELETE ON contacts BEGIN
+            DELETE FROM memberships WHERE contact = old.seq;
+        END;
+        CREATE TABLE IF NOT EXISTS contact_keys (contact INTEGER NOT NULL, field TEXT NOT NULL, key TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS contact_keys_key ON contact_keys(field, key);
+        CREATE INDEX IF NOT EXISTS contact_keys_contact ON contact_keys(contact);
+        CREATE TRIGGER IF NOT EXISTS contacts_delete_keys AFTER DELETE ON contacts BEGIN
+            DELETE FROM contact_keys WHERE contact = old.seq;
+        END;
+    """
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE contacts_fts USING fts5(
+            id, name, phone, email, company, notes, group_names,
+            content='contacts', content_rowid='seq', tokenize='trigram'
+        );
+        CREATE TRIGGER contacts_fts_insert AFTER INSERT ON contacts BEGIN
+            INSERT INTO contacts_fts(rowid, id, name, phone, email, company, notes, group_names)
+            VALUES (new.seq, new.id, new.name, new.phone, new.email, new.company, new.notes, new.group_names);
+        END;
+        CREATE TRIGGER contacts_fts_delete AFTER DELETE ON contacts BEGIN
+            INSERT INTO contacts_fts(contacts_fts, rowid, id, name, phone, email, company, notes, group_names)
+            VALUES ('delete', old.seq, old.id, old.name, old.phone, old.email, old.company, old.notes, old.group_names);
+        END;
+        CREATE TRIGGER contacts_fts_update AFTER UPDATE ON contacts BEGIN
+            INSERT INTO contacts_fts(contacts_fts, rowid, id, name, phone, email, company, notes, group_names)
+            VALUES ('delete', old.seq, old.id, old.name, old.phone, old.email, old.company, old.notes, old.group_names);
+            INSERT INTO contacts_fts(rowid, id, name, phone, email, company, notes, group_names)
+            VALUES (new.seq, new.id, new.name, new.phone, new.email, new.company, new.notes, new.group_names);
+        END;
+        INSERT INTO contacts_fts(contacts_fts) VALUES ('rebuild');
+    """
+    COLUMNS = "seq, id, name, phone, email, company, notes, group_names"
 
-    results = []
+    def __init__(self, filename):
+        self.filename = filename
+        # The number of changes in the open transaction
+        self.changes = 0
+        self.db = sqlite3.connect(filename)
+        self.db.create_function('regexp', 2, sqlite_regexp, deterministic=True)
+        self.db.executescript(self.SCHEMA)
+        self.fts = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'contacts_fts'").fetchone() is not None
+        if not self.fts:
+            try:
+                self.db.executescript(self.FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                # FTS5 or its trigram tokenizer is not available, searches scan the contacts table
+                pass
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+        if row is not None:
+            reserve_contact_ids(row[0])
+        if self.db.execute("SELECT 1 FROM meta WHERE key = 'contact_keys'").fetchone() is None:
+            # Databases written before the phone and email keys were added
+            for c in list(self.contacts()):
+                self.add_keys(c)
+            self.db.execute("INSERT INTO meta (key, value) VALUES ('contact_keys', 1)")
+            self.db.commit()
 
-    if fields[0] == 'all' and advanced:
-        # search all fields for the search term
-        for contact in CONTACTS:
-            if search_terms[0].lower() in contact.id.lower():
-                results.append(contact)
-                continue
-            if search_terms[0].lower() in contact.name.lower():
-                results.append(contact)
-                continue
-            if search_terms[0].lower() in contact.phone.lower():
-                results.append(contact)
-                continue
-            if search_terms[0].lower() in contact.email.lower():
-                results.append(contact)
-                continue
-            if search_terms[0].lower() in contact.company.lower():
-                results.append(contact)
-                continue
-            if search_terms[0].lower() in contact.notes.lower():
-                results.append(contact)
-                continue
-            for group in contact.groups:
-                if search_terms[0].lower() in group.lower():
-                    results.append(contact)
-                    continue
-    # Refine search results by fields specified. Only keep results that match the search term in the specified field.
-    if len(fields) > 1 and advanced:
-        for i in range(1, len(fields)):
-            # If the value is not found in the specified field, remove the contact from the results.
-            if fields[i] == 'id':
-                for contact in results:
-                    if search_terms[i] != contact.id:
-                        results.remove(contact)
-            if fields[i] == 'name':
-                for contact in results:
-                    if search_terms[i].lower() not in contact.name.lower():
-                        results.remove(contact)
-            if fields[i] == 'phone':
-                for contact in results:
-                    if search_terms[i].lower() not in contact.phone.lower():
-                        results.remove(contact)
-            if fields[i] == 'email':
-                for contact in results:
-                    if search_terms[i].lower() not in contact.email.lower():
-                        results.remove(contact)
-            if fields[i] == 'company':
-                for contact in results:
-                    if search_terms[i].lower() not in contact.company.lower():
-                        results.remove(contact)
-            if fields[i] == 'notes':
-                for contact in results:
-                    if search_terms[i].lower() not in contact.notes.lower():
-                        results.remove(contact)
-            if fields[i] == 'groups':
-                for contact in results:
-                    for group in contact.groups:
-                        if search_terms[i].lower() in group.lower():
-                            break
-                        else:
-                            results.remove(contact)
-    if not advanced:
-        # Join the search terms together and search for them in the name, phone, email, company, and notes fields.
-        search_term = " ".join(search_terms)
-        for contact in CONTACTS:
-            if search_term.lower() in contact.id.lower():
-                results.append(contact)
-                continue
-            if search_term.lower() in contact.name.lower():
-                results.append(contact)
-                continue
-            if search_term.lower() in contact.phone.lower():
-                results.append(contact)
-                continue
-            if search_term.lower() in contact.email.lower():
-                results.append(contact)
-                continue
-            if search_term.lower() in contact.company.lower():
-                results.append(contact)
-                continue
-            if search_term.lower() in contact.notes.lower():
-                results.append(contact)
-                continue
-            for group in contact.groups:
-                if search_term.lower() in group.lower():
-                    results.append(contact)
-                    continue
-        
+    def contact(self, row):
+        """Build a contact from a row of the contacts table.
+        """
+        c = Contact(row[1], row[2], row[3], row[4], row[5], row[6], row[7].split("\n") if row[7] else [])
+        c.seq = row[0]
+        return c
 
-    return results
+    def query(self, sql, parameters=()):
+        """Run a query on the contacts table and return the contacts it finds.
+        """
+        return [self.contact(row) for row in self.db.execute(f"SELECT {self.COLUMNS} FROM contacts {sql}", parameters)]
 
-def generate_contact_id():
-    """Generate a unique identifier for a contact.
+    def add(self, contact, record=True):
+        store_changed()
+        if contact.id.isdigit():
+            reserve_contact_ids(int(contact.id) + 1)
+        cursor = self.db.execute("INSERT INTO contacts (id, name, phone, email, company, notes, group_names) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (contact.id, contact.name, contact.phone, contact.email, contact.company, contact.notes, "\n".join(contact.groups)))
+        contact.seq = cursor.lastrowid
+        self.db.executemany("INSERT INTO memberships (contact, grp) VALUES (?, ?)", [(contact.seq, g) for g in contact.groups])
+        self.add_keys(contact)
+        self.changes += 1
 
-    Returns:
-        identifier (str): A unique identifier.
+    def add_keys(self, contact):
+        """Add the phone and email keys of a contact to the contact_keys table.
+        """
+        keys = [('phone', phone_key(contact.phone)), ('email', email_key(contact.email))]
+        self.db.executemany("INSERT INTO contact_keys (contact, field, key) VALUES (?, ?, ?)", [(contact.seq, f, k) for f, k in keys if k])
+
+    def add_many(self, contacts):
+        for contact in contacts:
+            self.add(contact)
+
+    def remove(self, contact, record=True):
+        store_changed()
+        self.db.execute("DELETE FROM contacts WHERE seq = ?", (contact.seq,))
+        self.changes += 1
+
+    def update(self, contact, fields, record=True):
+        store_changed()
+        for field, value in fields.items():
+            setattr(contact, field, value)
+        self.db.execute("UPDATE contacts SET id = ?, name = ?, phone = ?, email = ?, company = ?, notes = ?, group_names = ? WHERE seq = ?",
+            (contact.id, contact.name, contact.phone, contact.email, contact.company, contact.notes, "\n".join(contact.groups), contact.seq))
+        if 'groups' in fields:
+            self.db.execute("DELETE FROM memberships WHERE contact = ?", (contact.seq,))
+            self.db.executemany("INSERT INTO memberships (contact, grp) VALUES (?, ?)", [(contact.seq, g) for g in contact.groups])
+        if 'phone' in fields or 'email' in fields:
+            self.db.execute("DELETE FROM contact_keys WHERE contact = ?", (contact.seq,))
+            self.add_keys(contact)
+        self.changes += 1
+
+    def add_to_group(self, group_name, contact, record=True):
+        if group_name in contact.groups:
+            return False
+        self.update(contact, {'groups': contact.groups + (group_name,)})
+        return True
+
+    def remove_from_group(self, group_name, contact, record=True):
+        if group_name not in contact.groups:
+            return False
+        self.update(contact, {'groups': [g for g in contact.groups if g != group_name]})
+        return True
+
+    def get(self, id):
+        found = self.query("WHERE id = ? ORDER BY seq LIMIT 1", (id,))
+        return found[0] if found else None
+
+    def lookup(self, field, key):
+        return self.query("WHERE seq IN (SELECT contact FROM contact_keys WHERE field = ? AND key = ?) ORDER BY seq", (field, key))
+
+    def predicate_sql(self, field, value):
+        """Build the SQL condition for one search predicate.
+        """
+        if field == 'id':
+            return "id = ?", [value]
+        column = 'group_names' if field == 'groups' else field
+        if self.fts and len(value) >= NGRAM_SIZE:
+            phrase = '"' + value.replace('"', '""') + '"'
+            return "seq IN (SELECT rowid FROM contacts_fts WHERE contacts_fts MATCH ?)", [phrase if field == 'all' else f"{column} : {phrase}"]
+        columns = ['id', 'name', 'phone', 'email', 'company', 'notes', 'group_names'] if field == 'all' else [column]
+        return "(" + " OR ".join(f"instr(lower({c}), ?) > 0" for c in columns) + ")", [value] * len(columns)
+
+    def search(self, predicates):
+        predicates = [(field, value if field == 'id' else value.lower(), excluded) for field, value, excluded in predicates]
+        conditions = []
+        parameters = []
+        for field, value, excluded in predicates:
+            condition, values = self.predicate_sql(field, value)
+            conditions.append(("NOT " if excluded else "") + condition)
+            parameters.extend(values)
+        candidates = self.query("WHERE " + " AND ".join(conditions) + " ORDER BY seq", parameters)
+        # SQLite only folds the case of ASCII letters, so check the candidates the same way as in memory
+        return [c for c in candidates if all(field_matches(c, field, value) != excluded for field, value, excluded in predicates)]
+
+    def scan(self, kind, pattern, fields):
+        columns = ['group_names' if f == 'groups' else f for f in fields]
+        if kind == 'regex':
+            re.compile(pattern)
+            return self.query("WHERE " + " OR ".join(f"regexp(?, {c})" for c in columns) + " ORDER BY seq", [pattern] * len(columns))
+        return self.search([('all' if fields == SEARCH_FIELDS else fields[0], pattern, False)])
+
+    def ranked_search(self, search_terms, value, k):
+        return best_matches(search(search_terms), value.lower().strip(), k)
+
+    def count(self):
+        return self.db.execute("SELECT count(*) FROM contacts").fetchone()[0]
+
+    def contacts(self, offset=0, limit=None):
+        """Read contacts in the order they were added, one row at a time.
+        """
+        rows = self.db.execute(f"SELECT {self.COLUMNS} FROM contacts ORDER BY seq LIMIT ? OFFSET ?", (-1 if limit is None else limit, offset))
+        return (self.contact(row) for row in rows)
+
+    def company_counts(self):
+        return dict(self.db.execute("SELECT company, count(*) FROM contacts WHERE company != '' GROUP BY company"))
+
+    def group_counts(self):
+        return dict(self.db.execute("SELECT grp, count(*) FROM memberships GROUP BY grp"))
+
+    def fix(self, record=True):
+        store_changed()
+        self.changes += self.db.execute("DELETE FROM contacts WHERE seq NOT IN (SELECT min(seq) FROM contacts GROUP BY id)").rowcount
+
+    def is_saved(self, filename):
+        return filename == self.filename and not self.changes
+
+    @instrumented('load_contents')
+    def load(self, filename, background=False):
+        """Add the contacts of another contacts file to the database, straight away.
+        They are added under a savepoint, so a file that can't be read adds none of its contacts.
+        """
+        changes = self.changes
+        if not self.db.in_transaction:
+            # Otherwise releasing the savepoint would commit
+            self.db.execute("BEGIN")
+        self.db.execute("SAVEPOINT load")
+        try:
+            if is_sqlite_file(filename):
+                other = SqliteStorage(filename)
+                try:
+                    self.add_many(other.contacts())
+                finally:
+                    other.close()
+            else:
+                with open(filename, 'r') as f:
+                    self.add_many(Contact(c['id'], c['name'], c['phone'], c['email'], c['company'], c['notes'], c['groups']) for c in iter_contacts_file(f, filename))
+        except (OSError, ValueError, KeyError, TypeError, sqlite3.Error) as e:
+            self.db.execute("ROLLBACK TO load")
+            self.db.execute("RELEASE load")
+            self.changes = changes
+            store_changed()
+            print(f"Error: '{filename}' is not in the correct format ({e!r}), so none of its contacts were loaded.")
+            return None
+        self.db.execute("RELEASE load")
+        return True
+
+    def save(self, filename):
+        """Commit the changes when saving to the database, otherwise write every contact to the file.
+        """
+        if filename == self.filename:
+            self.commit()
+        elif is_sqlite_file(filename):
+            export_to_sqlite(filename)
+        else:
+            write_json_contacts(filename, self.contacts(), {'next_id': NEXT_CONTACT_ID})
+
+    def commit(self):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('next_id', ?)", (NEXT_CONTACT_ID,))
+        self.db.commit()
+        self.changes = 0
+
+    def close(self):
+        self.db.close()
+
+@instrumented('fix')
+def fix(record=True):
+    """Delete duplicate contacts and empty groups/companies.
+    The first contact with each id in each file is kept, so shards can reuse each other's ids.
     """
-    id = ''
-    for i in range(0, 5):
-        id += str(time.time())[-1]
-    return id
+    wait_for_load()
+    STORAGE.fix(record)
 
-def contacts_dict_to_list(contact_dict):
-    """Convert the contacts dictionary to a list of contact objects.
+# Likely duplicates are found by only comparing contacts that share a blocking key: the same phone
+# number, the same email address, or names that sound alike (with the same email domain, or on their own).
+# Blocks bigger than DEDUPE_MAX_BLOCK are too common to tell anything and are skipped. Pairs scoring at
+# least DEDUPE_THRESHOLD are the same person.
+DEDUPE_MAX_BLOCK = 100
+DEDUPE_THRESHOLD = 0.85
+DEDUPE_REPORT_SIZE = 50
+SOUNDEX_CODES = {c: str(code) for code, letters in enumerate(['aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r']) for c in letters}
+
+def soundex(word):
+    """Get the Soundex code of a word, eg. 'R163' for both 'Robert' and 'Rupert'.
     """
-    for contact in contact_dict:
-        c = Contact(contact['id'], contact['name'], contact['phone'], contact['email'], contact['company'], contact['notes'], contact['groups'])
-        CONTACTS.append(c)
-        if c.company != '':
-            if c.company not in COMPANIES:
-                COMPANIES[c.company] = []
-            COMPANIES[c.company].append(c)
-        for g in c.groups:
-            if g not in GROUPS:
-                GROUPS[g] = []
-            GROUPS[g].append(c)
+    word = ''.join(c for c in word.lower() if c in SOUNDEX_CODES)
+    if not word:
+        return ''
+    code = word[0].upper()
+    last = SOUNDEX_CODES[word[0]]
+    for c in word[1:]:
+        digit = SOUNDEX_CODES[c]
+        if digit != '0' and digit != last:
+            code += digit
+        if c not in 'hw':
+            last = digit
+    return (code + '000')[:4]
 
-def contacts_list_to_dict(contact_list):
-    """Convert the contacts list to a dictionary of contact objects.
+def name_tokens(name):
+    """Get the lowercase words of a name in sorted order, so 'Doe, Jane' and 'jane doe' are the same.
     """
-    converted_contacts = []
-    for contact in contact_list:
-        c = {
-            'id': contact.id,
-            'name': contact.name,
-            'phone': contact.phone,
-            'email': contact.email,
-            'company': contact.company,
-            'notes': contact.notes,
-            'groups': contact.groups
-        }
-        converted_contacts.append(c)
-    return converted_contacts
+    return sorted(re.findall(r"\w+", name.lower()))
 
-def load_contents(filename):
-    """Load the contacts file from CONTACTS_FILE.
+def blocking_keys(contact):
+    """Get the keys of the blocks a contact is compared within.
     """
+    keys = []
+    phone = phone_key(contact.phone)
+    if len(phone) >= 7:
+        keys.append(('phone', phone))
+    email = email_key(contact.email)
+    if '@' in email:
+        keys.append(('email', email))
+    sounds = " ".join(sorted(soundex(t) for t in name_tokens(contact.name)))
+    if sounds:
+        keys.append(('name', sounds))
+        if '@' in email:
+            keys.append(('domain', email.rpartition('@')[2], sounds))
+    return keys
 
-    # Load data from file
-    if os.path.isfile(filename):
-        with open(filename, 'r') as f:
-            
-            # Check if the file is in the correct format, if not then show an error message and continue.
-            try:
-                data = json.load(f)
-                CONTACTS = contacts_dict_to_list(data['contacts'])
-            except JSONDecodeError:
-                print("Error: The file is not in the correct format.")
-                return
-        return True
-    else:
-        print(f"No contacts file was found for '{CONTACTS_FILE}'")
-        return False
+def duplicate_score(a, b):
+    """Score how likely two contacts are to be the same person, from 0 to 1.
+    Similar names count for most of the score, and a matching phone number, email address or company adds to it.
+    """
+    name_a = " ".join(name_tokens(a.name))
+    name_b = " ".join(name_tokens(b.name))
+    score = 0.6 * difflib.SequenceMatcher(None, name_a, name_b).ratio() if name_a and name_b else 0.0
+    if phone_key(a.phone) and phone_key(a.phone) == phone_key(b.phone):
+        score += 0.25
+    if email_key(a.email) and email_key(a.email) == email_key(b.email):
+        score += 0.25
+    if a.company and a.company.lower() == b.company.lower():
+        score += 0.1
+    return min(score, 1.0)
 
-def save_contents(filename):
-    """Save the contacts file to a JSON file.
+def find_duplicates(threshold=DEDUPE_THRESHOLD):
+    """Find groups of contacts that are likely to be the same person, even with different ids.
+
+    Returns:
+        clusters (list): Lists of contacts in the order they were added, one list per person.
     """
-    with open(filename, 'w') as f:
-        data = {
-            'contacts': contacts_list_to_dict(CONTACTS)
-        }
-        json.dump(data, f, indent=4)
+    wait_for_load()
+    contacts = list(STORAGE.contacts())
+    blocks = {}
+    for i, c in enumerate(contacts):
+        for key in blocking_keys(c):
+            blocks.setdefault(key, []).append(i)
+    # Contacts joined by a pair that scored high enough are in the same cluster
+    parent = list(range(len(contacts)))
 
-def fix():
-    """Delete duplicate contacts and empty groups/companies.
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    scored = set()
+    for members in blocks.values():
+        if len(members) < 2 or len(members) > DEDUPE_MAX_BLOCK:
+            continue
+        for x, i in enumerate(members):
+            for j in members[x + 1:]:
+                if (i, j) in scored or root(i) == root(j):
+                    continue
+                scored.add((i, j))
+                if duplicate_score(contacts[i], contacts[j]) >= threshold:
+                    parent[root(j)] = root(i)
+    clusters = {}
+    for i in range(len(contacts)):
+        clusters.setdefault(root(i), []).append(contacts[i])
+    return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+def merge_duplicates(cluster):
+    """Merge a cluster of duplicate contacts into the first one.
+    Its groups and notes become the union of all of theirs, and its empty fields are filled in from the others.
+    The others are removed.
     """
-    for contact in CONTACTS:
-        for c in CONTACTS:
-            if contact != c and contact.id == c.id:
-                CONTACTS.remove(c)
-    for group in GROUPS:
-        for c in GROUPS[group]:
-            if c not in CONTACTS:
-                GROUPS[group].remove(c)
-    for company in COMPANIES:
-        for c in COMPANIES[company]:
-            if c not in CONTACTS:
-                COMPANIES[company].remove(c)
+    keep = cluster[0]
+    fields = {}
+    for field in ('name', 'phone', 'email', 'company'):
+        if not getattr(keep, field):
+            fields[field] = next((getattr(c, field) for c in cluster if getattr(c, field)), '')
+    fields['notes'] = "; ".join(dict.fromkeys(c.notes for c in cluster if c.notes))
+    fields['groups'] = tuple(dict.fromkeys(g for c in cluster for g in c.groups))
+    fields = {field: value for field, value in fields.items() if value != getattr(keep, field)}
+    if 'groups' in fields:
+        fields['groups'] = list(fields['groups'])
+    if fields:
+        update_contact(keep, **fields)
+    for c in cluster[1:]:
+        remove_contact(c)
 
 def splash():
     """Print a startup splash screen with the application name and version.
@@ -345,56 +2666,357 @@ def splash():
    """)
     print(f"{APPLICATION_NAME} v{VERSION}\n")
 
-def execute_commands(command_list):
-    """Execute a list of commands.
+def parse_commands(command_list):
+    """Parse a list of command lines into a list of operations.
+    Lines after an 'add' that start with a contact field fill in the fields of that contact.
+
+    Args:
+        command_list (list): The command lines.
+
+    Returns:
+        operations (list): (line, command, argument) tuples. The argument of an 'add' is a
+            dictionary of contact fields, for 'remove' it is the list of search terms.
     """
-    for c in range(0, len(command_list)):
-        line  = command_list[c].strip()
-        print(f"Executing command: {line}")
+    sub_commands = ['name', 'phone', 'email', 'company', 'notes', 'groups']
+    operations = []
+    fields = None
+    for line in command_list:
+        line = line.strip()
         words = line.split()
+        if len(words) == 0:
+            continue
+        field = words[0].replace(':', '')
+        if fields is not None and field in sub_commands:
+            value = " ".join(line.replace(':', '').split()[1:])
+            if field == 'groups':
+                fields['groups'] = [g.strip() for g in value.split(',') if g.strip()]
+            else:
+                fields[field] = value
+            continue
+        fields = None
         if words[0] == 'add':
-            sub_commands = ['name', 'phone', 'email', 'company', 'notes', 'groups']
-            name = ""
-            phone = ""
-            email = ""
-            company = ""
-            notes = ""
-            groups = []
-            for i in range(c+1, len(command_list)):
-                line = command_list[i]
-                words = line.replace(':', '').split()
-                
-                if words[0] not in sub_commands:
-                    break
-                if words[0] == 'name':
-                    name = " ".join(words[1:])
-                if words[0] == 'phone':
-                    phone = " ".join(words[1:])
-                if words[0] == 'email':
-                    email = " ".join(words[1:])
-                if words[0] == 'company':
-                    company = " ".join(words[1:])
-                if words[0] == 'notes':
-                    notes = " ".join(words[1:])
-            contact = Contact(generate_contact_id(), name, phone, email, company, notes, groups)
-            CONTACTS.append(contact)
+            fields = {'name': '', 'phone': '', 'email': '', 'company': '', 'notes': '', 'groups': []}
+            operations.append((line, 'add', fields))
         elif words[0] == 'remove':
-            query = words[1:]
-            results = search(query)
-            if len(results) == 1:
-                print(f"Removing contact '{results[0].name}'")
-                print_contacts(results)
-                CONTACTS.remove(results[0])
-                print("Contact removed.")
-            elif len(results) > 1:
-                print("Multiple contacts found:")
-                print_contacts(results)
-                print("Removing mutliple contacts is not supported in this mode.")
-                print("No contacts removed.")
+            operations.append((line, 'remove', words[1:]))
+        else:
+            operations.append((line, words[0], words[1:]))
+    return operations
+
+@instrumented('execute_commands')
+def execute_commands(command_list, quiet=False):
+    """Execute a list of commands.
+    The script is parsed once and contacts are indexed together once it has run,
+    or when a command needs to search them.
+
+    Args:
+        command_list (list): The command lines.
+        quiet (bool): Only print the summary.
+
+    Returns:
+        applied (int): The number of commands that were applied.
+        failed (int): The number of commands that failed.
+    """
+    operations = parse_commands(command_list)
+    ids = iter(allocate_contact_ids(sum(1 for op in operations if op[1] == 'add')))
+    applied = 0
+    failed = 0
+    defer_indexing(True)
+    try:
+        for line, command, argument in operations:
+            if not quiet:
+                print(f"Executing command: {line}")
+            if command == 'add':
+                f = argument
+                add_contact(Contact(next(ids), f['name'], f['phone'], f['email'], f['company'], f['notes'], f['groups']))
+                applied += 1
+            elif command == 'remove':
+                results = search(argument)
+                if len(results) == 1:
+                    if not quiet:
+                        print(f"Removing contact '{results[0].name}'")
+                        print_contacts(results)
+                    remove_contact(results[0])
+                    applied += 1
+                    if not quiet:
+                        print("Contact removed.")
+                elif len(results) > 1:
+                    failed += 1
+                    if not quiet:
+                        print("Multiple contacts found:")
+                        print_contacts(results)
+                        print("Removing mutliple contacts is not supported in this mode.")
+                        print("No contacts removed.")
+                else:
+                    failed += 1
+                    if not quiet:
+                        print("No contacts found.")
             else:
-                print("No contacts found.")
-            
+                failed += 1
+                if not quiet:
+                    print(f"Unsupported command: {command}")
+    finally:
+        defer_indexing(False)
+    print(f"Applied {applied} commands, {failed} failed.")
+    return applied, failed
+
+def contact_fields(body):
+    """Read the contact fields of an API request body.
+
+    Args:
+        body (bytes): A JSON object of contact fields, eg. {"name": "Jane Doe", "groups": ["work"]}.
+
+    Returns:
+        fields (dict): The fields.
+
+    Raises:
+        ValueError: The body is not a JSON object of contact fields.
+    """
+    fields = json.loads(body or b'{}')
+    if type(fields) != dict:
+        raise ValueError('Expected a JSON object of contact fields.')
+    for field, value in fields.items():
+        if field not in SEARCH_FIELDS[1:]:
+            raise ValueError(f"Unknown field '{field}'.")
+        if field == 'groups':
+            if type(value) != list or any(type(g) != str for g in value):
+                raise ValueError("'groups' must be a list of strings.")
+        elif type(value) != str:
+            raise ValueError(f"'{field}' must be a string.")
+    return fields
+
+@instrumented('api_request')
+def api_request(method, path, query, body):
+    """Answer one request to the HTTP API.
+
+        GET    /contacts?q=<query>&offset=<n>&limit=<n>  search, or list every contact without q
+        GET    /contacts?q=<query>&top=<n>                the n best matches, best first
+        POST   /contacts                                 add a contact, the body holds its fields
+        GET    /contacts/<id>                            get a contact
+        PATCH  /contacts/<id>                            change the fields in the body
+        DELETE /contacts/<id>                            remove a contact
+        GET    /lookup?phone=<number> or ?email=<address>  the contacts with exactly this phone number or email address
+        GET    /groups                                   the number of contacts in each group
+        PUT    /groups/<group>/<id>                      add a contact to a group
+        DELETE /groups/<group>/<id>                      remove a contact from a group
+
+    Args:
+        method (str): The HTTP method.
+        path (str): The path of the URL.
+        query (dict): The query string parameters, as returned by parse_qs.
+        body (bytes): The request body.
+
+    Returns:
+        status (int): The HTTP status code.
+        response: The JSON response.
+        changed (bool): Whether the contacts were changed.
+    """
+    wait_for_load(quiet=True)
+    parts = [unquote(p) for p in path.strip('/').split('/')]
+    if parts[0] == 'contacts' and len(parts) == 1:
+        if method == 'GET':
+            offset = max(0, int(query.get('offset', ['0'])[0]))
+            limit = int(query['limit'][0]) if 'limit' in query else None
+            terms = shlex.split(query.get('q', [''])[0])
+            if terms and 'top' in query:
+                results = ranked_search(terms, int(query['top'][0]))
+                count = len(results)
+            elif terms:
+                results = search(terms)
+                count = len(results)
+                results = results[offset:None if limit is None else offset + limit]
+            else:
+                count = count_contacts()
+                results = list_contacts(offset, limit)
+            return 200, {'count': count, 'contacts': [contact_to_dict(c) for c in results]}, False
+        if method == 'POST':
+            fields = {'name': '', 'phone': '', 'email': '', 'company': '', 'notes': '', 'groups': []}
+            fields.update(contact_fields(body))
+            wait_for_load(quiet=True)
+            contact = Contact(generate_contact_id(), **fields)
+            add_contact(contact)
+            return 201, contact_to_dict(contact), True
+        return 405, {'error': f"{method} is not supported on /contacts."}, False
+    if parts[0] == 'contacts' and len(parts) == 2:
+        contact = get_contact_by_id(parts[1])
+        if contact is None:
+            return 404, {'error': f"No contact with id '{parts[1]}'."}, False
+        if method == 'GET':
+            return 200, contact_to_dict(contact), False
+        if method == 'PATCH':
+            fields = contact_fields(body)
+            if fields:
+                update_contact(contact, **fields)
+            return 200, contact_to_dict(get_contact_by_id(parts[1])), bool(fields)
+        if method == 'DELETE':
+            remove_contact(contact)
+            return 200, contact_to_dict(contact), True
+        return 405, {'error': f"{method} is not supported on /contacts/<id>."}, False
+    if parts[0] == 'lookup' and len(parts) == 1:
+        if method != 'GET':
+            return 405, {'error': f"{method} is not supported on /lookup."}, False
+        field = 'phone' if 'phone' in query else 'email'
+        if field not in query:
+            raise ValueError("Expected a phone or email parameter.")
+        results = lookup(field, query[field][0])
+        return 200, {'count': len(results), 'contacts': [contact_to_dict(c) for c in results]}, False
+    if parts[0] == 'groups' and len(parts) == 1:
+        if method == 'GET':
+            return 200, group_counts(), False
+        return 405, {'error': f"{method} is not supported on /groups."}, False
+    if parts[0] == 'groups' and len(parts) == 3:
+        contact = get_contact_by_id(parts[2])
+        if contact is None:
+            return 404, {'error': f"No contact with id '{parts[2]}'."}, False
+        if method == 'PUT':
+            changed = add_to_group(parts[1], contact)
+        elif method == 'DELETE':
+            changed = remove_from_group(parts[1], contact)
+        else:
+            return 405, {'error': f"{method} is not supported on /groups/<group>/<id>."}, False
+        return 200, contact_to_dict(get_contact_by_id(parts[2])), changed
+    return 404, {'error': f"Unknown path '{path}'."}, False
+
+class ApiServer:
+    """Serve the contacts as JSON over HTTP.
+    Connections are handled by an asyncio event loop and requests run on worker threads, so many
+    clients can read at once. Changes are made one at a time, and are saved together on a timer
+    instead of once per request.
+    """
+    def __init__(self, host=SERVER_HOST, port=SERVER_PORT, save_delay=SAVE_DELAY):
+        self.host = host
+        self.port = port
+        self.save_delay = save_delay
+        self.write_lock = None
+        self.save_timer = None
+        self.server = None
+
+    async def start(self):
+        """Start listening. The port is chosen by the system when it is 0.
+        """
+        self.write_lock = asyncio.Lock()
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop listening and save any unsaved changes.
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        if self.save_timer is not None:
+            self.save_timer.cancel()
+            await self.save()
+
+    async def run(self):
+        await self.start()
+        print(f"Serving '{CONTACTS_FILE}' on http://{self.host}:{self.port}/ (Ctrl+C to stop)")
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await self.stop()
+
+    async def handle_connection(self, reader, writer):
+        """Answer the requests sent on one connection until the client closes it.
+        """
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                url = urlsplit(target)
+                status, response = await self.dispatch(method, url.path, parse_qs(url.query), body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                payload = json.dumps(response).encode()
+                writer.write(f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(payload)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            # Idle connections are cancelled when the server stops
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """Read one HTTP request.
+
+        Returns:
+            request (tuple): (method, target, headers, body), or None once the client has closed the connection.
+        """
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        method, target, _ = line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', 0))
+        if length > MAX_REQUEST_SIZE:
+            raise ValueError('Request body too large.')
+        body = await reader.readexactly(length) if length else b''
+        return method.upper(), target, headers, body
+
+    async def dispatch(self, method, path, query, body):
+        """Run a request on a worker thread, one at a time if it can change the contacts.
+
+        Returns:
+            status (int): The HTTP status code.
+            response: The JSON response.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            if method in ('GET', 'HEAD'):
+                status, response, changed = await self.call(loop, method, path, query, body)
+            else:
+                async with self.write_lock:
+                    status, response, changed = await self.call(loop, method, path, query, body)
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        if changed:
+            self.schedule_save()
+        return status, response
 
+    async def call(self, loop, *request):
+        if STORAGE.SINGLE_THREADED:
+            return api_request(*request)
+        return await loop.run_in_executor(None, api_request, *request)
+
+    def schedule_save(self):
+        """Save in save_delay seconds, unless a save is already waiting.
+        """
+        if self.save_timer is None:
+            self.save_timer = asyncio.get_running_loop().call_later(self.save_delay, lambda: asyncio.ensure_future(self.save()))
+
+    async def save(self):
+        """Save the changes made since the last save to the contacts file.
+        """
+        async with self.write_lock:
+            self.save_timer = None
+            if STORAGE.SINGLE_THREADED:
+                save_contents(CONTACTS_FILE)
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, save_contents, CONTACTS_FILE)
+
+def serve(host=SERVER_HOST, port=SERVER_PORT):
+    """Serve the contacts over HTTP until interrupted.
+    """
+    try:
+        asyncio.run(ApiServer(host, port, SAVE_DELAY).run())
+    except KeyboardInterrupt:
+        pass
+    print("Goodbye!")
 
 def main_loop():
     """The main loop of the program.
@@ -402,20 +3024,61 @@ def main_loop():
     global CONTACTS_FILE
     global GROUPS
     global CONTACTS
+    global INSTRUMENTATION
     dataset = []
     commands_log = []
+    # The command being timed and when it started, and the profiler of a 'profile' command
+    timed = None
+    profiler = None
     while True:
+        if timed is not None:
+            record_timing('command ' + timed[0], time.perf_counter() - timed[1])
+            timed = None
+        if profiler is not None:
+            profiler.disable()
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+            profiler = None
         command = input('> ')
         commands_log.append(command)
         command = shlex.split(command)
         if len(command) == 0:
             continue
+        if command[0] == 'profile':
+            if len(command) == 1:
+                print('Usage: profile <command>')
+                continue
+            # Run the rest of the line as a command under cProfile, the report is printed once it has finished
+            command = command[1:]
+            profiler = cProfile.Profile()
+            profiler.enable()
+        if INSTRUMENTATION and command[0] != 'stats':
+            timed = (command[0], time.perf_counter())
+        if command[0] in ('add', 'import', 'commands'):
+            # New contacts need ids, which aren't known to be free until the whole file is loaded
+            wait_for_load()
+        elif command[0] not in ('help', 'about', 'info') and LOAD_PROGRESS['size'] <= BACKGROUND_LOAD_SIZE:
+            # Small files are loaded by the time anyone notices, big ones can be searched while they load
+            wait_for_load(quiet=True)
 
         if command[0] == 'load':
             if len(command) == 1:
                 print('Please specify a file name.')
                 continue
             filename = command[1]
+            wait_for_load()
+            if isinstance(STORAGE, MemoryStorage) and not is_sqlite_file(filename) and (CONTACTS or SHARDS):
+                # Keep the file apart from the contacts already loaded, so saving writes each file back on its own
+                shard = find_shard(filename)
+                if shard is not None and SHARDS[shard]['changes'] and not yorn_prompt(f"Discard the unsaved changes to '{shard}'?", default="n"):
+                    continue
+                if load_shard(filename):
+                    print(f"Loaded {len(SHARDS[filename]['contacts'])} contacts from '{filename}'. Changes to them are saved back to it.")
+                continue
+            if isinstance(STORAGE, SqliteStorage) and os.path.abspath(filename) != os.path.abspath(STORAGE.filename):
+                # The contacts are copied into the open database, which stays the contacts file
+                if load_contents(filename):
+                    print(f"Imported the contacts from '{filename}' into '{STORAGE.filename}'. Save to keep them.")
+                continue
             if load_contents(filename):
                 CONTACTS_FILE = filename
                 print(f"Loaded contacts from '{filename}'.")
@@ -427,6 +3090,20 @@ def main_loop():
                         SETTINGS['contacts_file'] = filename
                         with open(CONFIG_FILE, 'a') as f:
                             f.write(f"\ncontacts_file={filename}")
+        elif command[0] == 'unload':
+            if len(command) == 1:
+                print('Please specify a file name.')
+                continue
+            shard = find_shard(command[1])
+            if shard is None:
+                print(f"'{command[1]}' is not loaded on top of the contacts file.")
+                continue
+            if SHARDS[shard]['changes'] and yorn_prompt(f"Save the changes to '{shard}' first?", show_proceed=False):
+                if not save_shard(shard):
+                    continue
+            count = len(SHARDS[shard]['contacts'])
+            unload_shard(shard)
+            print(f"Unloaded {count} contacts from '{shard}'.")
         elif command[0] == 'group':
             if len(command) == 1:
                 print('Usage: group <add|remove> <group_name> <contact>')
@@ -436,15 +3113,10 @@ def main_loop():
                     print('Usage: group add <group_name> <contact>')
                     continue
                 group_name = command[2]
-                contact = command[3]
-                contact = search(contact)
-                print(contact)
+                contact = search(command[3:])
                 if len(contact) == 1:
                     contact = contact[0]
-                    if group_name not in GROUPS:
-                        GROUPS[group_name] = []
-                    if contact not in GROUPS[group_name]:
-                        GROUPS[group_name].append(contact)
+                    if add_to_group(group_name, contact):
                         print(f"Added '{contact.name}' to group '{group_name}'.")
                     else:
                         print(f"Contact '{contact.name}' is already in group '{group_name}'.")
@@ -460,13 +3132,11 @@ def main_loop():
                     print('Usage: group remove <group_name> <contact>')
                     continue
                 group_name = command[2]
-                contact = command[3]
-                contact = search(contact)
+                contact = search(command[3:])
                 if len(contact) == 1:
                     contact = contact[0]
-                    if group_name in GROUPS:
-                        if contact in GROUPS[group_name]:
-                            GROUPS[group_name].remove(contact)
+                    if group_name in group_counts():
+                        if remove_from_group(group_name, contact):
                             print(f"Removed '{contact.name}' from group '{group_name}'.")
                         else:
                             print(f"Contact '{contact.name}' is not in group '{group_name}'.")
@@ -481,25 +3151,85 @@ def main_loop():
                     print("No contacts found.")
             else:
                 print('Usage: group <add|remove> <group_name> <contact>')
-            fix()
         elif command[0] == 'save':
-            save_contents(CONTACTS_FILE)
+            if is_saved(CONTACTS_FILE):
+                print("No changes to save.")
+            else:
+                save_contents(CONTACTS_FILE)
         elif command[0] == 'export':
             if len(command) == 1:
                 print('Please specify a file name.')
                 continue
             filename = command[1]
-            save_contents(filename)
+            format = command[command.index('--format') + 1] if '--format' in command[:-1] else None
+            if file_format(filename, format) is not None:
+                print(f"Exported {export_contacts(filename, file_format(filename, format))} contacts to '{filename}'.")
+            elif format is not None:
+                print(f"Unknown format '{format}'. Formats: {', '.join(CONTACT_FORMATS)}")
+            else:
+                save_contents(filename)
+        elif command[0] == 'import':
+            if len(command) == 1:
+                print('Usage: import <filename> [--format csv|vcard|ndjson]')
+                continue
+            filename = command[1]
+            format = command[command.index('--format') + 1] if '--format' in command[:-1] else None
+            if not os.path.isfile(filename):
+                print(f"No file was found for '{filename}'")
+            elif file_format(filename, format) is None:
+                print(f"Unknown format '{format}'." if format is not None else f"Can't tell the format of '{filename}'.",
+                      f"Use --format with one of: {', '.join(CONTACT_FORMATS)}")
+            else:
+                format = file_format(filename, format)
+                before = count_contacts()
+                try:
+                    print(f"Imported {import_contacts(filename, format)} contacts from '{filename}'.")
+                except (ValueError, csv.Error, UnicodeDecodeError) as e:
+                    # Contacts are added as they are read, so the ones before the error stay
+                    print(f"Error: '{filename}' is not a valid {format} file ({e}). "
+                          f"Imported the {count_contacts() - before} contacts before the error.")
         elif command[0] == 'commands':
             if len(command) == 1:
                 print('Please specify a file name.')
                 continue
             filename = command[1]
+            if not os.path.isfile(filename):
+                print(f"No commands file was found for '{filename}'")
+                continue
             with open(filename, 'r') as f:
                 commands = f.readlines()
-                execute_commands(commands)          
+            execute_commands(commands, quiet='--quiet' in command or '-q' in command)
+        elif command[0] == 'compact':
+            compact(CONTACTS_FILE)
         elif command[0] == 'fix':
             fix()
+        elif command[0] == 'lookup':
+            if len(command) < 3 or command[1] not in ('phone', 'email'):
+                print('Usage: lookup <phone|email> <phone number or email address>')
+                continue
+            results = lookup(command[1], " ".join(command[2:]))
+            if results:
+                print_contacts(results)
+            else:
+                print("No contacts found.")
+        elif command[0] == 'dedupe':
+            clusters = find_duplicates()
+            if not clusters:
+                print("No likely duplicates found.")
+                continue
+            print(f"Found {len(clusters)} people entered more than once ({sum(len(c) for c in clusters)} contacts):")
+            for cluster in clusters[:DEDUPE_REPORT_SIZE]:
+                print_contacts(cluster)
+            if len(clusters) > DEDUPE_REPORT_SIZE:
+                print(f"... and {len(clusters) - DEDUPE_REPORT_SIZE} more.")
+            if '--dry-run' in command:
+                continue
+            if yorn_prompt("Merge each of these into its first contact?", default="n"):
+                for cluster in clusters:
+                    merge_duplicates(cluster)
+                print(f"Merged {sum(len(c) for c in clusters) - len(clusters)} contacts.")
+            else:
+                print("No contacts merged.")
         elif command[0] == 'about':
             print('------------------------------')
             print('About')
@@ -510,70 +3240,65 @@ def main_loop():
         elif command[0] == 'info':
             print('------------------------------')
             print('Info')
-            print('Contacts: ', len(CONTACTS))
-            print('Companies: ', len(COMPANIES))
+            if not LOAD_PROGRESS['done']:
+                print(f"Loading '{LOAD_PROGRESS['filename']}': {load_percentage()}%")
+            print('Contacts: ', count_contacts())
+            print('Unsaved changes: ', unsaved_changes())
+            print('Companies: ', len(company_counts()))
             print_companies()
-            print('\nGroups: ', len(GROUPS))
+            print('\nGroups: ', len(group_counts()))
             print_groups()
+            if SHARDS:
+                print('\nFiles: ', len(SHARDS) + 1)
+                print(f"{CONTACTS_FILE}: {len(CONTACTS) - sum(len(shard['contacts']) for shard in SHARDS.values())}")
+                for shard in SHARDS:
+                    changes = len(SHARDS[shard]['changes'])
+                    print(f"{shard}: {len(SHARDS[shard]['contacts'])}" + (f" ({changes} unsaved changes)" if changes else ''))
             print('------------------------------\n')
         elif command[0] == 'exit' or command[0] == 'quit':
-            if not ALWAYS_SAVE_ON_EXIT:
-                if yorn_prompt("Save changes before exiting?", show_proceed=False):
-                    save_contents(CONTACTS_FILE)
-            else:
+            if not is_saved(CONTACTS_FILE) and (ALWAYS_SAVE_ON_EXIT or yorn_prompt("Save changes before exiting?", show_proceed=False)):
                 save_contents(CONTACTS_FILE)
+            STORAGE.close()
             print("Goodbye!")
             break
         elif command[0] == 'search':
             if len(command) == 1:
-                print('Usage: search <search term>')
+                print('Usage: search <search term> [field:value] [-field:value]')
                 continue
             query = command[1:]
-            results = search(query)
-            print(f"Search results for '{query[0]}':")
+            if query[0] == '--regex':
+                if len(query) == 1:
+                    print('Usage: search --regex [field:]<expression>')
+                    continue
+                field, sep, pattern = query[1].partition(':')
+                if not sep or field not in SEARCH_FIELDS:
+                    field, pattern = 'all', " ".join(query[1:])
+                try:
+                    results = regex_search(pattern, field)
+                except re.error as e:
+                    print(f"Invalid regular expression: {e}")
+                    continue
+            elif query[0] == '--top':
+                try:
+                    k = int(query[1])
+                except (IndexError, ValueError):
+                    print('Usage: search --top <n> <search term>')
+                    continue
+                query = query[2:]
+                results = ranked_search(query, k)
+            else:
+                results = search(query)
+            print(f"Search results for '{' '.join(query)}':")
             print_contacts(results)
-
-            ### Deprecated ###
-
-            # get search terms and possible filed indicated by a '-' prefix
-            # First term is always searched in all fields
-            # if len(command) == 1:
-            #     query = input('Query: ')
-            # else:
-            #     query = command[1:]
-            # search_terms = []
-            # fields = []
-            # # If first term is a '-' prefix, search only in the specified fields. Otherwise search in all fields then check for '-' prefixes
-            # if query[0][0] != '-':
-            #     search_terms.append(query[0])
-            #     fields.append('all')
-            #     query = query[1:]
-            
-            # for term in query:
-            #     if term[0] == '-':
-            #         fields.append(term[1:])
-            #         print(f"field {term[1:]} at index {fields.index(term[1:])}")
-            #     else:
-            #         search_terms.append(term)
-            #         print(f"search term {term} at index {search_terms.index(term)}")
-            # results = search(search_terms, fields)
-            # print_contacts(results)
         elif command[0] == 'add':
             contact = Contact(generate_contact_id(), '', '', '', '', '', [])
-            contact.id = generate_contact_id()
             contact.name = input('Name: ')
             contact.phone = input('Phone: ')
             contact.email = input('Email: ')
             contact.company = input('Company: ')
             contact.notes = input('Notes: ')
-            CONTACTS.append(contact)
+            add_contact(contact)
             print(f"Added contact '{contact.name}'.")
-            # Check for company
-            if contact.company != '':
-                if contact.company not in COMPANIES:
-                    COMPANIES[contact.company] = [contact]
-                else:
-                    COMPANIES[contact.company].append(contact)
         elif command[0] == 'remove':
             if len(command) == 1:
                 print('Usage: remove <contact>')
@@ -583,7 +3308,7 @@ def main_loop():
             if len(results) == 1:
                 print_contacts(results)
                 if yorn_prompt("Are you sure you want to remove this contact?", default="n"):
-                    CONTACTS.remove(results[0])
+                    remove_contact(results[0])
                     print("Contact removed.")
                 else:
                     print("No contacts removed.")
@@ -592,7 +3317,7 @@ def main_loop():
                 print_contacts(results)
                 if yorn_prompt("Are you sure you want to remove these contacts?", default="n"):
                     for c in results:
-                        CONTACTS.remove(c)
+                        remove_contact(c)
                     print("Removed contacts.")
                 else:
                     print("No contacts removed.")
@@ -608,11 +3333,12 @@ def main_loop():
                 print_contacts(results)
                 c = results[0]
                 if yorn_prompt("Edit this contact?"):
-                    c.name = input('Name [' + c.name + ']: ') or c.name
-                    c.phone = input('Phone [' + c.phone + ']: ') or c.phone
-                    c.email = input('Email [' + c.email + ']: ') or c.email
-                    c.company = input('Company [' + c.company + ']: ') or c.company
-                    c.notes = input('Notes [' + c.notes + ']: ') or c.notes
+                    name = input('Name [' + c.name + ']: ') or c.name
+                    phone = input('Phone [' + c.phone + ']: ') or c.phone
+                    email = input('Email [' + c.email + ']: ') or c.email
+                    company = input('Company [' + c.company + ']: ') or c.company
+                    notes = input('Notes [' + c.notes + ']: ') or c.notes
+                    update_contact(c, name=name, phone=phone, email=email, company=company, notes=notes)
             elif len(results) > 1:
                 print("Multiple contacts found:")
                 print_contacts(results)
@@ -629,7 +3355,7 @@ def main_loop():
                 print_contacts(results)
                 c = results[0]
                 if yorn_prompt("Edit this contact?"):
-                    c.notes = input('Notes [' + c.notes + ']: ') or c.notes
+                    update_contact(c, notes=input('Notes [' + c.notes + ']: ') or c.notes)
             elif len(results) > 1:
                 print("Multiple contacts found:")
                 print_contacts(results)
@@ -641,9 +3367,44 @@ def main_loop():
                 print("Usage: list [contacts|groups]")
             else:
                 if command[1] == 'contacts':
-                    print_contacts(CONTACTS)
+                    options = {'--page': None, '--page-size': PAGE_SIZE, '--offset': 0, '--limit': None}
+                    try:
+                        for i in range(2, len(command) - 1, 2):
+                            if command[i] not in options:
+                                raise ValueError(command[i])
+                            options[command[i]] = int(command[i + 1])
+                    except ValueError:
+                        print("Usage: list contacts [--page <n>] [--page-size <n>] [--offset <n>] [--limit <n>]")
+                        continue
+                    if options['--page'] is not None:
+                        page = max(1, options['--page'])
+                        page_size = max(1, options['--page-size'])
+                        count = count_contacts()
+                        pages = max(1, -(-count // page_size))
+                        print_contacts(list_contacts((page - 1) * page_size, page_size))
+                        print(f"Page {page} of {pages} ({count} contacts)")
+                    else:
+                        print_contacts(list_contacts(max(0, options['--offset']), options['--limit']))
                 elif command[1] == 'groups':
                     print_groups()
+        elif command[0] == 'stats':
+            if len(command) > 1 and command[1] == 'on':
+                INSTRUMENTATION = True
+                print("Instrumentation is on.")
+            elif len(command) > 1 and command[1] == 'off':
+                INSTRUMENTATION = False
+                print("Instrumentation is off.")
+            elif len(command) > 1 and command[1] == 'reset':
+                with STATS_LOCK:
+                    STATS.clear()
+                with STORE_LOCK:
+                    QUERY_CACHE_STATS.update(hits=0, misses=0)
+                print("Statistics cleared.")
+            elif len(command) > 1:
+                write_stats(command[1])
+                print(f"Statistics written to '{command[1]}'.")
+            else:
+                print_stats()
         elif command[0] == 'help':
             print(HELP)
         else:
@@ -657,6 +3418,16 @@ def boot():
     global CONFIG_FILE
     global ALWAYS_SAVE_ON_EXIT
     global SPLASH_SCREEN
+    global JOURNAL_MODE
+    global PARALLEL_SCAN
+    global SCAN_WORKERS
+    global LAZY_LOAD
+    global SNAPSHOT_CACHE
+    global SERVER_PORT
+    global SAVE_DELAY
+    global INSTRUMENTATION
+    global COMPACT_JSON
+    serving = False
     if len(sys.argv) > 1:
         for flag in sys.argv:
             if flag == '-f':
@@ -666,6 +3437,18 @@ def boot():
             if flag == '-v':
                 print(VERSION)
                 sys.exit()
+
+            if flag == '--serve':
+                # Serve the contacts over HTTP instead of starting the prompt
+                serving = True
+
+            if flag == '--port':
+                SERVER_PORT = int(sys.argv[sys.argv.index(flag) + 1])
+
+            if flag == '--stats':
+                # Time commands and write the statistics to a JSON file on exit
+                INSTRUMENTATION = True
+                atexit.register(write_stats, sys.argv[sys.argv.index(flag) + 1])
     # Look for a config file
     if os.path.isfile(CONFIG_FILE):
         # Config file is just variable names and values separated by '='
@@ -684,13 +3467,35 @@ def boot():
                         ALWAYS_SAVE_ON_EXIT = True if val == 'true' else False
                     elif var == 'splash_screen':
                         SPLASH_SCREEN = True if val == 'true' else False
+                    elif var == 'journal':
+                        JOURNAL_MODE = True if val == 'true' else False
+                    elif var == 'parallel_scan':
+                        PARALLEL_SCAN = True if val == 'true' else False
+                    elif var == 'scan_workers':
+                        SCAN_WORKERS = int(val)
+                    elif var == 'lazy_load':
+                        LAZY_LOAD = True if val == 'true' else False
+                    elif var == 'snapshot_cache':
+                        SNAPSHOT_CACHE = True if val == 'true' else False
+                    elif var == 'server_port':
+                        SERVER_PORT = int(val)
+                    elif var == 'save_delay':
+                        SAVE_DELAY = float(val)
+                    elif var == 'instrumentation':
+                        INSTRUMENTATION = True if val == 'true' else False
+                    elif var == 'compact_json':
+                        COMPACT_JSON = True if val == 'true' else False
                     else:
                         print(f'Unknown variable {var}')
                         continue
                     SETTINGS[var] = val
     # Then load the credentials file
-    load_contents(CONTACTS_FILE)
+    # Load in the background so the prompt is usable straight away
+    load_contents(CONTACTS_FILE, background=LAZY_LOAD or (os.path.isfile(CONTACTS_FILE) and os.path.getsize(CONTACTS_FILE) > BACKGROUND_LOAD_SIZE))
     splash()
+    if serving:
+        serve(SERVER_HOST, SERVER_PORT)
+        return
     # load_credentials()
     # Then load the contacts file
     # Main loop
@@ -0,0 +1,491 @@
+"""
+Tests for loading, journaling and merging contacts files, and for the HTTP API.
+File: test_final_contacts.py
+
+Usage:
+    python -m unittest test_final_contacts
+"""
+import asyncio
+import contextlib
+import http.client
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import unittest
+from json.decoder import JSONDecodeError
+
+import final_contacts as fc
+
+
+def record(id, name, **fields):
+    """Build a contact dictionary with empty fields apart from those given.
+    """
+    contact = {'id': id, 'name': name, 'phone': '', 'email': '', 'company': '', 'notes': '', 'groups': []}
+    contact.update(fields)
+    return contact
+
+
+def quietly(function, *args, **kwargs):
+    """Call a function with its output thrown away.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args, **kwargs)
+
+
+class ContactsFileTest(unittest.TestCase):
+    """Runs each test in a temporary directory holding 'contacts.json', with an empty store.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.filename = os.path.join(directory.name, 'contacts.json')
+        fc.clear_contacts()
+        fc.PENDING_CHANGES.clear()
+        fc.FAILED_LOADS.clear()
+        fc.set_journal_base(None)
+        fc.STORAGE = fc.MemoryStorage()
+        fc.SNAPSHOT_CACHE = False
+        fc.JOURNAL_MODE = False
+        fc.CONTACTS_FILE = self.filename
+
+    def tearDown(self):
+        fc.JOURNAL_MODE = False
+        fc.SNAPSHOT_CACHE = True
+
+    def write(self, contacts, **metadata):
+        """Write a contacts file the way another process would, replacing it rather than changing it in place.
+        """
+        with open(self.filename + '.new', 'w') as f:
+            json.dump(dict(metadata, contacts=contacts), f)
+        os.replace(self.filename + '.new', self.filename)
+
+    def read(self):
+        with open(self.filename) as f:
+            return json.load(f)['contacts']
+
+    def load(self):
+        fc.clear_contacts()
+        return quietly(fc.load_contents, self.filename)
+
+    def names(self):
+        return [(c.name, c.notes, list(c.groups)) for c in fc.CONTACTS]
+
+
+class IterJsonContactsTest(unittest.TestCase):
+
+    def parse(self, text, chunk_size):
+        metadata = {}
+        contacts = list(fc.iter_json_contacts(io.StringIO(text), metadata, chunk_size=chunk_size))
+        return contacts, metadata
+
+    def test_records_split_across_chunks(self):
+        contacts = [record('1', 'Jane "JD" Doe', notes='{not: [an object]}, \\ ok'), record('2', 'Bob', groups=['a', 'b'])]
+        text = json.dumps({'generation': 3, 'contacts': contacts, 'next_id': 12345}, indent=4)
+        for chunk_size in (1, 2, 7, 64, 1 << 16):
+            self.assertEqual(self.parse(text, chunk_size), (contacts, {'generation': 3, 'next_id': 12345}))
+
+    def test_empty_contacts(self):
+        self.assertEqual(self.parse('{"contacts": []}', 3), ([], {}))
+
+    def test_invalid_files(self):
+        for text in ('', '[]', '{"contacts": [{"id": "1"}', '{"contacts": [{"id": "1"} {"id": "2"}]}',
+                     '{"contacts": [{"id": "1"},]}', '{"contacts": [] "next_id": 1}'):
+            with self.assertRaises(JSONDecodeError):
+                self.parse(text, 4)
+
+
+class LoadTest(ContactsFileTest):
+
+    def test_bad_record_loads_nothing_and_is_never_saved_over(self):
+        contacts = [record('1', 'p1'), record('2', 'p2'), record('3', 'p3'), record('4', 'p4')]
+        del contacts[2]['notes']
+        self.write(contacts)
+        self.assertIsNone(self.load())
+        self.assertEqual(fc.CONTACTS, [])
+        fc.add_contact(fc.Contact(**record('5', 'new')))
+        quietly(fc.save_contents, self.filename)
+        quietly(fc.compact, self.filename)
+        self.assertEqual(self.read(), contacts)
+
+    def test_truncated_file_loads_nothing(self):
+        with open(self.filename, 'w') as f:
+            f.write(json.dumps({'contacts': [record('1', 'p1'), record('2', 'p2')]})[:-20])
+        self.assertIsNone(self.load())
+        self.assertEqual(fc.CONTACTS, [])
+
+    def test_cache_of_replaced_file_is_not_used(self):
+        fc.SNAPSHOT_CACHE = True
+        self.write([record('1', 'Old')])
+        iter_contacts_file = fc.iter_contacts_file
+
+        def replaced_while_loading(f, filename, metadata=None):
+            for contact in iter_contacts_file(f, filename, metadata):
+                yield contact
+                self.write([record('1', 'New'), record('2', 'Newer')])
+        fc.iter_contacts_file = replaced_while_loading
+        try:
+            self.load()
+        finally:
+            fc.iter_contacts_file = iter_contacts_file
+        self.assertEqual(self.names(), [('Old', '', [])])
+        self.load()
+        self.assertEqual([c.name for c in fc.CONTACTS], ['New', 'Newer'])
+        self.load()
+        self.assertEqual([c.name for c in fc.CONTACTS], ['New', 'Newer'])
+
+
+class JournalTest(ContactsFileTest):
+
+    def setUp(self):
+        super().setUp()
+        fc.JOURNAL_MODE = True
+        self.write([record('00001', 'Alice'), record('00001', 'Bob'), record('00002', 'Carol')])
+        self.load()
+
+    def save(self):
+        quietly(fc.save_contents, self.filename)
+
+    def test_changes_are_replayed(self):
+        alice, bob, carol = fc.CONTACTS
+        fc.update_contact(bob, notes='bob note')
+        fc.add_to_group('vip', bob)
+        fc.remove_from_group('vip', bob)
+        fc.add_to_group('work', bob)
+        fc.remove_contact(carol)
+        fc.add_contact(fc.Contact(**record('00003', 'Dave')))
+        self.save()
+        self.assertTrue(os.path.isfile(fc.journal_path(self.filename)))
+        self.assertEqual(len(self.read()), 3)
+        self.load()
+        self.assertEqual(self.names(), [('Alice', '', []), ('Bob', 'bob note', ['work']), ('Dave', '', [])])
+
+    def test_incomplete_change_is_cut_off(self):
+        fc.update_contact(fc.CONTACTS[0], notes='kept')
+        self.save()
+        path = fc.journal_path(self.filename)
+        size = os.path.getsize(path)
+        with open(path, 'a') as f:
+            f.write('{"op": "edit", "id": "00002", "fie')
+        self.load()
+        self.assertEqual(fc.CONTACTS[0].notes, 'kept')
+        self.assertEqual(os.path.getsize(path), size)
+        # Later changes follow the last complete one
+        fc.update_contact(fc.CONTACTS[2], notes='after')
+        self.save()
+        self.load()
+        self.assertEqual([c.notes for c in fc.CONTACTS], ['kept', '', 'after'])
+
+    def test_fix_is_replayed_in_background_load(self):
+        quietly(fc.fix)
+        self.save()
+        fc.update_contact(fc.CONTACTS[1], notes='after fix')
+        self.save()
+        fc.clear_contacts()
+        self.assertTrue(quietly(fc.load_contents, self.filename, background=True))
+        fc.wait_for_load(quiet=True)
+        self.assertEqual(self.names(), [('Alice', '', []), ('Carol', 'after fix', [])])
+        self.assertNotIn(os.path.abspath(self.filename), fc.FAILED_LOADS)
+
+    def test_journal_of_older_file_is_ignored(self):
+        fc.update_contact(fc.CONTACTS[0], notes='old change')
+        self.save()
+        with open(fc.journal_path(self.filename)) as f:
+            journal = f.read()
+        quietly(fc.compact, self.filename)
+        self.assertFalse(os.path.exists(fc.journal_path(self.filename)))
+        fc.update_contact(fc.CONTACTS[0], notes='')
+        quietly(fc.write_snapshot, self.filename)
+        with open(fc.journal_path(self.filename), 'w') as f:
+            f.write(journal)
+        self.load()
+        self.assertEqual(fc.CONTACTS[0].notes, '')
+
+
+class MergeTest(ContactsFileTest):
+
+    def setUp(self):
+        super().setUp()
+        self.write([record('00001', 'Alice'), record('00001', 'Bob'), record('00002', 'Carol')], next_id=3)
+        self.load()
+
+    def save_elsewhere(self, change):
+        """Change the saved file as another process would."""
+        contacts = self.read()
+        change(contacts)
+        self.write(contacts, next_id=4)
+
+    def save(self):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            fc.save_contents(self.filename)
+        return output.getvalue()
+
+    def test_changes_to_different_contacts_are_kept(self):
+        fc.update_contact(fc.CONTACTS[1], notes='bob note')
+        fc.add_to_group('vip', fc.CONTACTS[1])
+        self.save_elsewhere(lambda contacts: contacts[0].update(notes='alice note'))
+        self.save()
+        self.assertEqual([(c['name'], c['notes'], c['groups']) for c in self.read()],
+                         [('Alice', 'alice note', []), ('Bob', 'bob note', ['vip']), ('Carol', '', [])])
+
+    def test_edit_finds_changed_contact_sharing_an_id(self):
+        fc.update_contact(fc.CONTACTS[1], notes='bob note')
+        self.save_elsewhere(lambda contacts: contacts[1].update(phone='555'))
+        self.save()
+        bob = self.read()[1]
+        self.assertEqual((bob['name'], bob['phone'], bob['notes']), ('Bob', '555', 'bob note'))
+        self.assertEqual(self.read()[0]['notes'], '')
+
+    def test_conflicting_edit_is_skipped(self):
+        fc.update_contact(fc.CONTACTS[2], notes='mine')
+        self.save_elsewhere(lambda contacts: contacts[2].update(notes='theirs'))
+        self.assertIn('1 changes were not applied', self.save())
+        self.assertEqual(self.read()[2]['notes'], 'theirs')
+
+    def test_same_edit_is_not_a_conflict(self):
+        fc.update_contact(fc.CONTACTS[2], notes='same')
+        self.save_elsewhere(lambda contacts: contacts[2].update(notes='same'))
+        self.assertNotIn('not applied', self.save())
+
+    def test_removing_contact_changed_elsewhere_is_skipped(self):
+        fc.remove_contact(fc.CONTACTS[2])
+        self.save_elsewhere(lambda contacts: contacts[2].update(notes='theirs'))
+        self.save()
+        self.assertEqual([c['name'] for c in self.read()], ['Alice', 'Bob', 'Carol'])
+
+    def test_added_id_taken_elsewhere_is_renamed(self):
+        contact = fc.Contact(fc.generate_contact_id(), 'Dave', '', '', '', '', [])
+        fc.add_contact(contact)
+        fc.update_contact(contact, notes='dave note')
+        self.save_elsewhere(lambda contacts: contacts.append(record(contact.id, 'Erin')))
+        self.save()
+        saved = {c['name']: c for c in self.read()}
+        self.assertNotEqual(saved['Dave']['id'], saved['Erin']['id'])
+        self.assertEqual(saved['Dave']['notes'], 'dave note')
+
+
+class StorageTest(ContactsFileTest):
+    """Runs the same operations on contacts kept in memory and in an SQLite database.
+    """
+
+    def tearDown(self):
+        fc.STORAGE.close()
+        super().tearDown()
+
+    def check_storage(self, filename):
+        self.write([record('00001', 'Jane Doe', phone='505-932-4523', company='Doe Inc.', groups=['work']),
+                    record('00001', 'Jane Copy'), record('00002', 'Bob', email='Bob@Example.com')], next_id=3)
+        quietly(fc.load_contents, self.filename)
+        if filename != self.filename:
+            fc.save_contents(filename)
+            fc.clear_contacts()
+            quietly(fc.load_contents, filename)
+        fc.CONTACTS_FILE = filename
+        self.assertTrue(fc.is_saved(filename))
+        self.assertEqual(fc.count_contacts(), 3)
+        jane = fc.get_contact_by_id('00001')
+        self.assertEqual(jane.name, 'Jane Doe')
+        self.assertEqual([c.name for c in fc.search(['doe'])], ['Jane Doe'])
+        self.assertEqual([c.name for c in fc.search(['groups:work', '-name:bob'])], ['Jane Doe'])
+        self.assertEqual([c.name for c in fc.regex_search('^b', 'name')], ['Bob'])
+        self.assertEqual([c.name for c in fc.lookup('phone', '(505) 932 4523')], ['Jane Doe'])
+        self.assertEqual([c.name for c in fc.lookup('email', 'bob@example.com')], ['Bob'])
+        self.assertEqual([c.name for c in fc.ranked_search(['bob'], 1)], ['Bob'])
+        self.assertEqual(fc.company_counts(), {'Doe Inc.': 1})
+
+        self.assertTrue(fc.add_to_group('vip', jane))
+        self.assertFalse(fc.add_to_group('vip', jane))
+        self.assertTrue(fc.remove_from_group('work', jane))
+        fc.update_contact(jane, notes='note')
+        fc.add_contact(fc.Contact(**record('00003', 'Dave')))
+        bob = fc.search(['bob'])[0]
+        fc.remove_contact(bob)
+        fc.fix()
+        self.assertEqual(fc.group_counts(), {'vip': 1})
+        self.assertEqual([c.name for c in fc.list_contacts(1)], ['Dave'])
+        self.assertFalse(fc.is_saved(filename))
+        self.assertGreater(fc.unsaved_changes(), 0)
+        fc.save_contents(filename)
+        self.assertEqual(fc.unsaved_changes(), 0)
+
+        export = os.path.join(os.path.dirname(self.filename), 'export.json')
+        fc.save_contents(export)
+        with open(export) as f:
+            saved = json.load(f)['contacts']
+        self.assertEqual([(c['id'], c['name'], c['notes'], c['groups']) for c in saved],
+                         [('00001', 'Jane Doe', 'note', ['vip']), ('00003', 'Dave', '', [])])
+
+    def test_bad_file_adds_nothing_to_sqlite(self):
+        database = os.path.join(os.path.dirname(self.filename), 'contacts.db')
+        self.write([record('00001', 'Jane')])
+        quietly(fc.load_contents, self.filename)
+        fc.save_contents(database)
+        fc.clear_contacts()
+        quietly(fc.load_contents, database)
+        fc.update_contact(fc.get_contact_by_id('00001'), notes='unsaved')
+        good = [record('00002', 'p2'), record('00003', 'p3')]
+        bad = os.path.join(os.path.dirname(self.filename), 'bad.json')
+        for text in (json.dumps({'contacts': good + [{'id': '00004'}]}), json.dumps({'contacts': good + [5]}),
+                     json.dumps({'contacts': good + good})[:-30]):
+            with open(bad, 'w') as f:
+                f.write(text)
+            self.assertIsNone(quietly(fc.load_contents, bad))
+            self.assertEqual(fc.count_contacts(), 1)
+            self.assertEqual(fc.unsaved_changes(), 1)
+        with open(bad, 'w') as f:
+            json.dump({'contacts': good}, f)
+        self.assertTrue(quietly(fc.load_contents, bad))
+        fc.save_contents(database)
+        self.assertEqual([(c.name, c.notes) for c in fc.list_contacts()], [('Jane', 'unsaved'), ('p2', ''), ('p3', '')])
+        fc.STORAGE.close()
+        fc.STORAGE = fc.MemoryStorage()
+        quietly(fc.load_contents, database)
+        self.assertEqual(fc.count_contacts(), 3)
+
+    def test_memory(self):
+        self.check_storage(self.filename)
+
+    def test_sqlite(self):
+        self.check_storage(os.path.join(os.path.dirname(self.filename), 'contacts.db'))
+
+
+class SearchTest(ContactsFileTest):
+
+    def test_field_searches_match_every_contact_they_should(self):
+        fc.contacts_dict_to_list([record(str(i), 'name%d' % i, company=['', 'Acme', 'Doe Inc.'][i % 3],
+                                         groups=[['work'], [], ['a', 'b']][i % 3 - 1 if i % 2 else i % 3]) for i in range(60)])
+        for query in (['company:'], ['groups:'], ['company:', 'name:1'], ['company:', '-company:acme'],
+                      ['groups:', 'company:'], ['company:doe'], ['groups:', '-groups:work']):
+            predicates = [(f, v if f == 'id' else v.lower(), x) for f, v, x in fc.parse_query(query)]
+            expected = [c for c in fc.CONTACTS if all(fc.field_matches(c, f, v) != x for f, v, x in predicates)]
+            self.assertEqual(fc.search(query), expected, query)
+
+
+class ScanTest(ContactsFileTest):
+
+    def tearDown(self):
+        super().tearDown()
+        fc.PARALLEL_SCAN = False
+        fc.PARALLEL_SCAN_THRESHOLD = 50000
+
+    def test_invalid_regex_fails_before_scanning(self):
+        fc.PARALLEL_SCAN = True
+        fc.PARALLEL_SCAN_THRESHOLD = 1
+        fc.contacts_dict_to_list([record(str(i), 'p%d' % i) for i in range(100)])
+        with self.assertRaises(re.error):
+            fc.regex_search('(unclosed')
+        self.assertEqual([c.name for c in fc.regex_search('^P9', 'name')], ['p9'] + ['p%d' % i for i in range(90, 100)])
+
+    def test_no_processes_are_forked_from_threads(self):
+        fc.PARALLEL_SCAN = True
+        fc.PARALLEL_SCAN_THRESHOLD = 1
+        fc.SCAN_WORKERS = 4
+        fc.contacts_dict_to_list([record(str(i), 'p%d' % i) for i in range(100)])
+        executor, cpu_count = fc.concurrent.futures.ProcessPoolExecutor, os.cpu_count
+        forked = []
+        fc.concurrent.futures.ProcessPoolExecutor = lambda *args, **kwargs: forked.append(args) or executor(*args, **kwargs)
+        os.cpu_count = lambda: 4
+        results = []
+        try:
+            thread = threading.Thread(target=lambda: results.append(fc.regex_search('^p9', 'name')))
+            thread.start()
+            thread.join()
+        finally:
+            fc.concurrent.futures.ProcessPoolExecutor, os.cpu_count = executor, cpu_count
+            fc.SCAN_WORKERS = os.cpu_count() or 1
+        self.assertEqual(forked, [])
+        self.assertEqual(len(results[0]), 11)
+
+
+class ExportTest(ContactsFileTest):
+
+    def test_csv_round_trip(self):
+        groups = ['a', 'c;d', 'back\\slash;', 'new\\n']
+        fc.add_contact(fc.Contact(**record('1', 'Jane, "JD"', notes='two\nlines', groups=groups)))
+        filename = os.path.join(os.path.dirname(self.filename), 'contacts.csv')
+        self.assertEqual(fc.export_contacts(filename, 'csv'), 1)
+        fc.clear_contacts()
+        self.assertEqual(quietly(fc.import_contacts, filename, 'csv'), 1)
+        self.assertEqual(fc.contact_to_dict(fc.CONTACTS[0]), record('1', 'Jane, "JD"', notes='two\nlines', groups=groups))
+
+    def test_ndjson_lines_must_be_objects(self):
+        filename = os.path.join(os.path.dirname(self.filename), 'contacts.ndjson')
+        for lines in (['5', json.dumps(record('1', 'p1'))], [json.dumps(record('1', 'p1')), '[1, 2]']):
+            fc.clear_contacts()
+            with open(filename, 'w') as f:
+                f.write("\n".join(lines) + "\n")
+            with self.assertRaises(ValueError):
+                fc.import_contacts(filename, 'ndjson')
+            self.assertEqual(fc.count_contacts(), 0 if lines[0] == '5' else 1)
+
+
+class ApiServerTest(ContactsFileTest):
+
+    def request(self, port, method, path, body=None):
+        """Send one request to the server with a local client.
+
+        Returns:
+            status (int): The HTTP status code.
+            response: The JSON response.
+        """
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+        try:
+            connection.request(method, path, body=body)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            connection.close()
+
+    def test_requests_and_debounced_save(self):
+        saves = []
+        save = fc.STORAGE.save
+        fc.STORAGE.save = lambda filename: (saves.append(filename), save(filename))
+        results = {}
+
+        async def session():
+            loop = asyncio.get_running_loop()
+            server = fc.ApiServer('127.0.0.1', 0, save_delay=0.2)
+            await server.start()
+
+            def client():
+                send = lambda *request: self.request(server.port, *request)
+                status, jane = send('POST', '/contacts', json.dumps({'name': 'Jane Doe', 'company': 'Acme'}))
+                results['post'] = status, jane
+                results['bob'] = send('POST', '/contacts', json.dumps({'name': 'Bob'}))
+                results['get'] = send('GET', f"/contacts/{jane['id']}")
+                results['patch'] = send('PATCH', f"/contacts/{jane['id']}", json.dumps({'phone': '555-0100'}))
+                results['delete'] = send('DELETE', f"/contacts/{results['bob'][1]['id']}")
+                results['deleted'] = send('GET', f"/contacts/{results['bob'][1]['id']}")
+                results['unknown field'] = send('POST', '/contacts', json.dumps({'age': '40'}))
+                results['bad value'] = send('PATCH', f"/contacts/{jane['id']}", json.dumps({'groups': 'work'}))
+                results['bad json'] = send('POST', '/contacts', '{"name": ')
+                results['not an object'] = send('POST', '/contacts', '["Jane"]')
+                results['saves before delay'] = len(saves)
+
+            try:
+                await loop.run_in_executor(None, client)
+                await asyncio.sleep(0.5)
+            finally:
+                await server.stop()
+
+        quietly(asyncio.run, session())
+        status, jane = results['post']
+        self.assertEqual(status, 201)
+        self.assertEqual(jane['name'], 'Jane Doe')
+        self.assertEqual(results['get'], (200, jane))
+        self.assertEqual(results['patch'], (200, dict(jane, phone='555-0100')))
+        self.assertEqual(results['delete'][0], 200)
+        self.assertEqual(results['deleted'][0], 404)
+        for name in ('unknown field', 'bad value', 'bad json', 'not an object'):
+            self.assertEqual(results[name][0], 400, name)
+            self.assertIn('error', results[name][1])
+        self.assertEqual(results['saves before delay'], 0)
+        self.assertEqual(saves, [self.filename])
+        self.assertEqual(self.read(), [dict(jane, phone='555-0100')])
+
+
+if __name__ == "__main__":
+    unittest.main()